@@ -0,0 +1,334 @@
+import io
+import os
+import sys
+import json
+import time
+import timeit
+import random
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+import contextlib
+from functools import wraps
+import fsspec
+from fsspec.implementations.memory import MemoryFileSystem
+from rena import utils, rfs
+from rena.config import *
+from rena.yaml_cache import get_yaml_cache
+from rena.experiment import generate_random_config_search, get_config_dirs, launch_search
+
+# Benchmarks for config access and loading and for sweep orchestration.
+#   python bench.py [--quick] [--only NAME ...] [--latency S] [--json PATH]
+# Sweep benchmarks run against slowmem://, an in-memory filesystem that
+# sleeps --latency seconds per request to stand in for S3. Results are
+# printed and, with --json, written as {"meta": ..., "results": [...]} so
+# runs of different versions can be compared.
+
+
+_request_lock = threading.Lock()
+_request_local = threading.local()
+
+def _request(fn):
+    # one request per outermost call, calls made inside it are free
+    @wraps(fn)
+    def wrapped(self, *args, **kwargs):
+        depth = getattr(_request_local, "depth", 0)
+        if depth == 0:
+            with _request_lock:
+                LatencyFileSystem.requests += 1
+            if LatencyFileSystem.latency > 0:
+                time.sleep(LatencyFileSystem.latency)
+        _request_local.depth = depth + 1
+        try:
+            return fn(self, *args, **kwargs)
+        finally:
+            _request_local.depth = depth
+    return wrapped
+
+
+class LatencyFileSystem(MemoryFileSystem):
+    # memory:// with a per-request latency, find is a single request like a
+    # paginated LIST on an object store
+    protocol = "slowmem"
+    store = {}
+    pseudo_dirs = [""]
+    latency = 0.0
+    requests = 0
+
+    @classmethod
+    def _strip_protocol(cls, path):
+        if isinstance(path, str) and path.startswith("slowmem://"):
+            path = path[len("slowmem://"):]
+        return super()._strip_protocol(path)
+
+    ls = _request(MemoryFileSystem.ls)
+    info = _request(MemoryFileSystem.info)
+    isfile = _request(MemoryFileSystem.isfile)
+    find = _request(MemoryFileSystem.find)
+    cat_file = _request(MemoryFileSystem.cat_file)
+    pipe_file = _request(MemoryFileSystem.pipe_file)
+    _open = _request(MemoryFileSystem._open)
+    rm = _request(MemoryFileSystem.rm)
+    cp_file = _request(MemoryFileSystem.cp_file)
+
+fsspec.register_implementation("slowmem", LatencyFileSystem, clobber=True)
+
+def _reset_slowmem(latency):
+    LatencyFileSystem.store.clear()
+    LatencyFileSystem.pseudo_dirs[:] = [""]
+    LatencyFileSystem.latency = latency
+    LatencyFileSystem.requests = 0
+
+
+def _result(name, value, unit, **params):
+    return {"name": name, "value": value, "unit": unit, "params": params}
+
+def _best(fn, repeat):
+    # best of repeat runs, in seconds
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+def _large_config(width=20, depth=3):
+    if depth == 0:
+        return random.choice([1e-4, 3, "relu", None, [1, 2, 3], True])
+    return {"k{}".format(i): _large_config(width, depth - 1) for i in range(width)}
+
+def _large_metrics(num_epochs=2000):
+    return {"epoch_{}".format(i): {"loss": random.random(), "acc": random.random(),
+                                   "lr": 1e-4 * random.random()}
+            for i in range(num_epochs)}
+
+def _random_path(config):
+    path = []
+    while isinstance(config, dict):
+        k = random.choice(sorted(config.keys()))
+        path.append(k)
+        config = config[k]
+    return path
+
+def _nested(path, value):
+    for k in reversed(path):
+        value = {k: value}
+    return value
+
+
+def bench_config_reads(args):
+    number = 10000 if args.quick else 100000
+    config_path = "configs/test+t-std.yaml"
+    configs = {
+        "none": load_config(config_path, usage_state_level="none"),
+        "count": load_config(config_path, usage_state_level="count"),
+        "hist": load_config(config_path, usage_state_level="hist"),
+        "hist(sample_rate=0.01)": load_config(config_path, hist_sample_rate=0.01),
+        "lazy(count)": load_config(config_path, usage_state_level="count", lazy=True),
+        "frozen": load_config(config_path, frozen=True),
+    }
+    res = []
+    for name, config in configs.items():
+        t = timeit.timeit(lambda: config.b.b3.b31.b41, number=number)
+        res.append(_result("config_read", t / number * 1e9, "ns/read", mode=name))
+    return res
+
+def bench_overlay_load(args):
+    # load_config of base+o0+...-mask, the overlays each change a few leaves
+    # deep in a large base config
+    random.seed(args.seed)
+    repeat = 3 if args.quick else 10
+    num_layers = 4 if args.quick else 16
+    res = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        base = _large_config()
+        utils.save_yaml(base, os.path.join(tmp_dir, "base.yaml"))
+        for i in range(num_layers):
+            overlay = {}
+            for _ in range(8):
+                overlay = utils.deep_update(overlay, _nested(_random_path(base), i))
+            utils.save_yaml(overlay, os.path.join(tmp_dir, "o{}.yaml".format(i)))
+        mask = {k: (1 if j % 2 else {"k0": 1, "k1": 1}) for j, k in enumerate(base) if j < 10}
+        utils.save_yaml(mask, os.path.join(tmp_dir, "mask.yaml"))
+        for layers in sorted(set([1, num_layers // 4, num_layers])):
+            names = ["base"] + ["o{}".format(i) for i in range(layers - 1)]
+            path = os.path.join(tmp_dir, "+".join(names))
+            for suffix in ["", "-mask"]:
+                for mode, kwargs in [("eager", {}), ("lazy", {"lazy": True}),
+                                     ("frozen", {"frozen": True}),
+                                     ("uncached", {"use_cache": False})]:
+                    def load():
+                        config = load_config(path + suffix, **kwargs)
+                        config.k0.k1.k2
+                    load()  # warm the yaml cache
+                    t = _best(load, repeat)
+                    res.append(_result("overlay_load", t * 1e3, "ms/load", layers=layers,
+                                       mask=suffix != "", mode=mode))
+    get_yaml_cache().clear()
+    return res
+
+def bench_flatten(args):
+    random.seed(args.seed)
+    repeat = 3 if args.quick else 5
+    res = []
+    for width, depth in [(20, 3)] + ([] if args.quick else [(10, 5)]):
+        config = Config(_large_config(width, depth), usage_state_level="none")
+        flat = flatten_config(config)
+        leaves = len(flat)
+        res.append(_result("flatten_config", _best(lambda: flatten_config(config), repeat) * 1e3,
+                           "ms", leaves=leaves))
+        res.append(_result("recover_flattened_config",
+                           _best(lambda: recover_flattened_config(flat), repeat) * 1e3,
+                           "ms", leaves=leaves))
+        view = config.flat_view()
+        names = list(view)[:1000]
+        t = _best(lambda: [view[name] for name in names], repeat)
+        res.append(_result("flat_view_read", t / len(names) * 1e9, "ns/read", leaves=leaves))
+    return res
+
+def bench_config_copy(args):
+    # copy a large config and set one leaf, as generate_random_config_search does
+    random.seed(args.seed)
+    number = 200 if args.quick else 1000
+    config = Config(_large_config(), usage_state_level="none")
+    t = timeit.timeit(lambda: config.copy().k0.k1.__setitem__("k2", 1), number=number)
+    return [_result("config_copy_set", t / number * 1e6, "us/variant")]
+
+def bench_yaml_backends(args):
+    random.seed(args.seed)
+    repeat = 1 if args.quick else 3
+    backends = ["python"] + (["c"] if utils.CLoader is not None else [])
+    res = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, obj in [("config", _large_config()), ("metrics", _large_metrics())]:
+            path = os.path.join(tmp_dir, name + ".yaml")
+            utils.save_yaml(obj, path)
+            size = os.path.getsize(path)
+            for backend in backends:
+                utils.set_yaml_backend(backend)
+                load_t = _best(lambda: utils.load_yaml(path), repeat)
+                dump_t = _best(lambda: utils.save_yaml(obj, path), repeat)
+                res.append(_result("yaml_load", size / load_t / 1e6, "MB/s",
+                                   doc=name, backend=backend))
+                res.append(_result("yaml_dump", size / dump_t / 1e6, "MB/s",
+                                   doc=name, backend=backend))
+    utils.set_yaml_backend("auto")
+    return res
+
+
+def _sweep_files(tmp_dir):
+    # a large base config and a search space over 5 of its leaves
+    base = _large_config()
+    search = {}
+    for _ in range(5):
+        search = utils.deep_update(search, _nested(_random_path(base), list(range(10))))
+    utils.save_yaml(base, os.path.join(tmp_dir, "base.yaml"))
+    utils.save_yaml(search, os.path.join(tmp_dir, "search.yaml"))
+    return os.path.join(tmp_dir, "base"), os.path.join(tmp_dir, "search")
+
+def _bench_trial(config):
+    return {"metrics": {"value": 1.0}}
+
+def bench_sweep(args):
+    # generate_random_config_search, get_config_dirs and launch_search on
+    # slowmem://, reporting wall time and the number of requests
+    random.seed(args.seed)
+    num_trials = 20 if args.quick else 100
+    res = []
+    cwd = os.getcwd()
+    session = rfs.get_session()
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            contextlib.redirect_stdout(io.StringIO()):
+        base_path, search_path = _sweep_files(tmp_dir)
+        _reset_slowmem(args.latency)
+        rfs.set_session(rfs.Session())
+        prefix = "slowmem://bench/sweep"
+        try:
+            t = time.perf_counter()
+            generate_random_config_search(base_path, search_path, prefix, num_trials,
+                                          seed=args.seed)
+            res.append(_result("generate_random_config_search", time.perf_counter() - t, "s",
+                                trials=num_trials, latency=args.latency,
+                                requests=LatencyFileSystem.requests))
+
+            LatencyFileSystem.requests = 0
+            t = time.perf_counter()
+            config_dirs = get_config_dirs(prefix, mode="todo")
+            res.append(_result("get_config_dirs", time.perf_counter() - t, "s",
+                               trials=len(config_dirs), latency=args.latency,
+                               requests=LatencyFileSystem.requests))
+
+            # trial dirs are also created locally, keep them in tmp_dir
+            os.chdir(tmp_dir)
+            LatencyFileSystem.requests = 0
+            t = time.perf_counter()
+            launch_search(_bench_trial, prefix, slots=1, poll_interval=0,
+                          exit_when_idle=True)
+            seconds = time.perf_counter() - t
+            finished = len(get_config_dirs(prefix, mode="finished"))
+            res.append(_result("launch_search", seconds, "s", trials=finished,
+                               latency=args.latency, requests=LatencyFileSystem.requests))
+        finally:
+            os.chdir(cwd)
+            rfs.set_session(session)
+            _reset_slowmem(0.0)
+    return res
+
+
+benchmarks = {
+    "config_reads": bench_config_reads,
+    "overlay_load": bench_overlay_load,
+    "flatten": bench_flatten,
+    "config_copy": bench_config_copy,
+    "yaml_backends": bench_yaml_backends,
+    "sweep": bench_sweep,
+}
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))
+                                       ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="rena benchmarks")
+    parser.add_argument("--only", nargs="+", choices=sorted(benchmarks.keys()))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="seconds per slowmem:// request")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes and fewer repeats")
+    parser.add_argument("--json", help="write results to this file, - for stdout")
+    args = parser.parse_args(argv)
+
+    out = sys.stderr if args.json == "-" else sys.stdout
+    results = []
+    for name in args.only or list(benchmarks.keys()):
+        for r in benchmarks[name](args):
+            params = " ".join("{}={}".format(k, v) for k, v in r["params"].items())
+            print("{:<30} {:12.3f} {:<10} {}".format(r["name"], r["value"], r["unit"], params),
+                  file=out)
+            results.append(r)
+    if args.json is not None:
+        doc = {"meta": {"commit": _git_commit(),
+                        "time": time.time(),
+                        "python": platform.python_version(),
+                        "platform": platform.platform(),
+                        "yaml_backend": utils.yaml_backend,
+                        "seed": args.seed,
+                        "latency": args.latency,
+                        "quick": args.quick},
+               "results": results}
+        if args.json == "-":
+            json.dump(doc, sys.stdout, indent=1)
+        else:
+            with open(args.json, "w") as f:
+                json.dump(doc, f, indent=1)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import os
+import time
+import mmap
+import pickle
+import struct
+from collections.abc import Mapping
+
+# Binary config encoding, version 1:
+#   header  magic, version, number of entries, number of items, number of
+#           top-level keys
+#   offsets items i spans data[offsets[i]:offsets[i + 1]]
+#   entries one 9-byte record per key in depth-first order: key item, tag,
+#           and an argument that is the number of children of a mapping, a
+#           small int itself, or the item holding the packed value
+#   data    the items, every distinct key or packed value stored once
+MAGIC = b"RCFG"
+VERSION = 1
+_header = struct.Struct("<4sBIII")
+_entry = struct.Struct("<IBi")
+
+_NODE, _NONE, _FALSE, _TRUE, _INT32, _INT64, _FLOAT, _STR, _PICKLE = range(9)
+_PICKLED_KEY = 0x80
+_int64 = struct.Struct("<q")
+_float64 = struct.Struct("<d")
+
+
+def encode(tree):
+    items = []
+    item_index = {}
+    entries = []
+
+    def item(b):
+        i = item_index.get(b)
+        if i is None:
+            i = item_index[b] = len(items)
+            items.append(b)
+        return i
+
+    def walk(node):
+        for k, v in node.items():
+            if isinstance(k, str):
+                key, flags = item(k.encode("utf-8")), 0
+            else:
+                key, flags = item(pickle.dumps(k)), _PICKLED_KEY
+            if isinstance(v, Mapping):
+                tag, arg = _NODE, len(v)
+            elif v is None:
+                tag, arg = _NONE, 0
+            elif v is True or v is False:
+                tag, arg = (_TRUE if v else _FALSE), 0
+            elif type(v) is int and -2 ** 31 <= v < 2 ** 31:
+                tag, arg = _INT32, v
+            elif type(v) is int and -2 ** 63 <= v < 2 ** 63:
+                tag, arg = _INT64, item(_int64.pack(v))
+            elif type(v) is float:
+                tag, arg = _FLOAT, item(_float64.pack(v))
+            elif type(v) is str:
+                tag, arg = _STR, item(v.encode("utf-8"))
+            else:
+                tag, arg = _PICKLE, item(pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL))
+            entries.append(_entry.pack(key, tag | flags, arg))
+            if tag == _NODE:
+                walk(v)
+
+    walk(tree)
+    offsets = [0]
+    for b in items:
+        offsets.append(offsets[-1] + len(b))
+    return b"".join([_header.pack(MAGIC, VERSION, len(entries), len(items), len(tree)),
+                     struct.pack("<{}I".format(len(offsets)), *offsets)]
+                    + entries + items)
+
+def decode(buf):
+    # buf can be any buffer (bytes, mmap, memoryview), it is read in place.
+    # Keys and str values are decoded once per distinct item and shared.
+    buf = memoryview(buf)
+    magic, version, num_entries, num_items, num_keys = _header.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("Not an encoded config")
+    if version != VERSION:
+        raise ValueError("Unsupported config encoding version {}".format(version))
+    pos = _header.size
+    offsets = struct.unpack_from("<{}I".format(num_items + 1), buf, pos)
+    pos += 4 * (num_items + 1)
+    entries = buf[pos:pos + num_entries * _entry.size]
+    data = buf[pos + num_entries * _entry.size:]
+    strs = {}
+
+    def get_str(i):
+        s = strs.get(i)
+        if s is None:
+            s = strs[i] = str(data[offsets[i]:offsets[i + 1]], "utf-8")
+        return s
+
+    root = {}
+    node, remaining = root, num_keys
+    stack = []
+    for key, tag, arg in _entry.iter_unpack(entries):
+        while remaining == 0:
+            node, remaining = stack.pop()
+        remaining -= 1
+        if tag & _PICKLED_KEY:
+            tag &= ~_PICKLED_KEY
+            k = pickle.loads(data[offsets[key]:offsets[key + 1]])
+        else:
+            k = get_str(key)
+        if tag == _NODE:
+            v = node[k] = {}
+            stack.append((node, remaining))
+            node, remaining = v, arg
+            continue
+        if tag == _NONE:
+            v = None
+        elif tag == _FALSE:
+            v = False
+        elif tag == _TRUE:
+            v = True
+        elif tag == _INT32:
+            v = arg
+        elif tag == _INT64:
+            v = _int64.unpack_from(data, offsets[arg])[0]
+        elif tag == _FLOAT:
+            v = _float64.unpack_from(data, offsets[arg])[0]
+        elif tag == _STR:
+            v = get_str(arg)
+        else:
+            v = pickle.loads(data[offsets[arg]:offsets[arg + 1]])
+        node[k] = v
+    # an mmap cannot be closed while views of it are alive
+    entries.release()
+    data.release()
+    buf.release()
+    return root
+
+
+def get_shm_dir():
+    shm_dir = os.environ.get("RENA_SHM_DIR")
+    if shm_dir is None:
+        shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else "/tmp"
+    return shm_dir
+
+def publish(path, data):
+    # Readers poll for path, the rename makes it appear complete.
+    tmp_path = "{}.tmp-{}".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def read_published(path, timeout=600, poll_interval=0.05, num_readers=None):
+    # Maps the file published at path and decodes it in place. None after
+    # timeout seconds without it. With num_readers, the last of that many
+    # readers to finish removes the file (see _release_published).
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        if time.time() > deadline:
+            return None
+        time.sleep(poll_interval)
+    try:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                res = decode(m)
+    except FileNotFoundError:
+        return None
+    if num_readers is not None:
+        _release_published(path, num_readers)
+    return res
+
+def _release_published(path, num_readers):
+    # Each reader takes the first free of num_readers marker slots, created
+    # exclusively, and the one taking the last slot removes the file and
+    # the markers.
+    marker_paths = ["{}.read-{}".format(path, i) for i in range(num_readers)]
+    for i, marker_path in enumerate(marker_paths):
+        try:
+            os.close(os.open(marker_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            continue
+        if i == num_readers - 1:
+            for p in [path] + marker_paths:
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
+        return
@@ -25,22 +25,31 @@ SOFTWARE.
 '''
 
 import os
-import re
-import yaml
+import json
+import hashlib
 import pprint
-import inspect
-import fsspec
+import weakref
 from copy import deepcopy
 from collections.abc import Mapping
-from .utils import deep_update, load_yaml, deep_filter
+from .utils import load_yaml, yaml_dump
+from .usage import record_call_site, resolve_hist
+from .yaml_cache import load_yaml_cached
+from .overlay import OverlayView
+from .paths import flatten_dict, unflatten_dict, PathIndex, FlatView
+from .instrument import timed
+from . import codec, dist, rfs
 
+# nodes a lazy Config turns into Configs on first access
+_lazy_types = (dict, OverlayView)
 
 def config_to_dict(x):
-    if isinstance(x, Config):
+    if isinstance(x, (Config, FrozenConfig)):
         res = {}
         for k, v in x._config_dict.items():
             res[k] = config_to_dict(v)
         return res
+    elif isinstance(x, OverlayView):
+        return x.to_dict()
     else:
         return x
 
@@ -48,72 +57,208 @@ def config_usage_to_dict(x, key):
     if isinstance(x, Config):
         res = {}
         for k, v in x._config_dict.items():
+            if isinstance(v, Config):
+                if k in x._shared:
+                    # still shared with the config this one was copied from,
+                    # whose reads do not count here
+                    v = v._clone()
+            elif x._lazy and isinstance(v, _lazy_types):
+                v = Config(v, usage_state_level="none", lazy=True)
+            elif k not in x._usage_state:
+                # lazy or copied leaves that were never read
+                res[k] = [] if key == "hist" else 0
+                continue
             res[k] = config_usage_to_dict(v, key)
         if hasattr(x, "_usage_state"):
             for kk, vv in x._usage_state.items():
-                res[kk] = vv[key]
+                if key == "hist":
+                    res[kk] = resolve_hist(vv.get("hist", {}))
+                else:
+                    res[kk] = vv[key]
         return res
     else:
         return {}
 
 
+def _config_items(node):
+    # children of a config node without counting usage; plain mappings are
+    # nodes inside lazy configs only
+    if isinstance(node, (Config, FrozenConfig)):
+        lazy = isinstance(node, Config) and node._lazy
+        for k, v in node._config_dict.items():
+            yield k, v, isinstance(v, (Config, FrozenConfig)) or (lazy and isinstance(v, _lazy_types))
+    else:
+        for k, v in node.items():
+            yield k, v, isinstance(v, Mapping)
+
 def flatten_config(c, prefix=""):
-    res = {}
-    for k, v in c._config_dict.items():
-        if prefix == "":
-            name = k
-        else:
-            name = prefix + "." + k
-        if isinstance(v, Config):
-            res.update(flatten_config(v, name))
-        else:
-            res[name] = v
-    return Config(res)
+    return Config(flatten_dict(c, _config_items, prefix))
+
+def config_path_index(c):
+    return PathIndex.from_tree(c, _config_items)
+
+def _canonical(x):
+    if isinstance(x, dict):
+        items = sorted(([repr(k), _canonical(v)] for k, v in x.items()),
+                       key=lambda kv: kv[0])
+        return ["dict", items]
+    elif isinstance(x, list):
+        return ["list", [_canonical(v) for v in x]]
+    elif isinstance(x, tuple):
+        return ["tuple", [_canonical(v) for v in x]]
+    return x
+
+def config_hash(config):
+    # Key-order independent and, unlike hash(), stable across processes.
+    canonical = json.dumps(_canonical(config_to_dict(config)),
+                           separators=(",", ":"), default=repr)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
 
 def recover_flattened_config(config):
-    config_dict = config_to_dict(config)
-    recovered_dict = {}
-    for k, v in config_dict.items():
-        ks = k.split(".")
-        _vv = v
-        for _k in reversed(ks):
-            res_dict = {_k: _vv}
-            _vv = res_dict
-        recovered_dict = deep_update(recovered_dict, res_dict)
-    return Config(recovered_dict)
+    return Config(unflatten_dict(config_to_dict(config)))
+
+
+_config_attrs = frozenset(["_config_dict", "_usage_state_level", "_usage_state",
+                           "_hist_sample_rate", "_lazy", "_shared", "_copies", "_parent"])
+
+_atomic_types = (int, float, str, bool, type(None))
 
 
 class Config(Mapping):
 
     def __init__(self,
                  config_dict={},
-                 usage_state_level="count"):
+                 usage_state_level="count",
+                 hist_sample_rate=1.0,
+                 lazy=False):
+        self._parent = None
         self.reset_config(config_dict=config_dict,
-                          usage_state_level=usage_state_level)
+                          usage_state_level=usage_state_level,
+                          hist_sample_rate=hist_sample_rate,
+                          lazy=lazy)
         
     def copy(self):
-        return Config(deepcopy(config_to_dict(self)))
+        # Copy-on-write: the copy shares the child nodes of self and clones a
+        # shared child (one node, not its subtree) when it first reaches it,
+        # so only the paths read or written through the copy get copied. self
+        # is left as it is, nodes fetched from it before or after copy() stay
+        # its own. Before a node is written, the copies sharing it or one of
+        # its ancestors get their own clones of its current state
+        # (_before_write). The copy starts with fresh usage state.
+        return self._clone()
+
+    def _clone(self):
+        res = Config.__new__(Config)
+        res._usage_state_level = self._usage_state_level
+        res._hist_sample_rate = self._hist_sample_rate
+        res._lazy = self._lazy
+        res._config_dict = dict(self._config_dict)
+        res._usage_state = {}
+        res._shared = set()
+        res._copies = None
+        res._parent = None
+        for k, v in res._config_dict.items():
+            if isinstance(v, Config):
+                res._shared.add(k)
+                v._add_copy(res, k)
+            elif not (isinstance(v, _atomic_types) or (self._lazy and isinstance(v, _lazy_types))):
+                # lists can be changed in place, lazy dicts are copied when
+                # materialized
+                res._config_dict[k] = deepcopy(v)
+        return res
 
-    def reset_config(self, config_dict, usage_state_level="count"):
+    def _add_copy(self, parent, key):
+        # parent[key] is self, shared with the config parent was cloned from.
+        # Copies that were dropped are pruned whenever the registry doubles.
+        copies = self._copies
+        if copies is None:
+            copies = self._copies = {}
+        elif len(copies) >= 64 and len(copies) & (len(copies) - 1) == 0:
+            for entry, ref in list(copies.items()):
+                if ref() is None:
+                    del copies[entry]
+        copies[(id(parent), key)] = weakref.ref(parent)
+
+    def _drop_shared(self, key):
+        self._shared.discard(key)
+        value = self._config_dict[key]
+        if value._copies is not None:
+            value._copies.pop((id(self), key), None)
+        return value
+
+    def _unshare(self, key):
+        value = self._config_dict[key] = self._drop_shared(key)._clone()
+        value._parent = self
+        return value
+
+    def _detach_copies(self):
+        # gives every copy still sharing self its own clone of self's current
+        # state, before self is written
+        copies = self._copies
+        self._copies = None
+        for (_, key), ref in list(copies.items()):
+            parent = ref()
+            if parent is not None and key in parent._shared and parent._config_dict[key] is self:
+                parent._unshare(key)
+
+    def _before_write(self):
+        # a copy may reach self through a shared ancestor, so the ancestors
+        # are detached first, top down, each detach registering the new
+        # clones on the next node of the path
+        path = []
+        node = self
+        while node is not None:
+            path.append(node)
+            node = node._parent
+        for node in reversed(path):
+            if node._copies:
+                node._detach_copies()
+
+    def freeze(self):
+        return freeze_dict(config_to_dict(self))
+
+    def flat_view(self, index=None):
+        # dotted-name view linked to this config, index can be shared by
+        # configs of the same structure (e.g. copies)
+        return FlatView(self, index if index is not None else config_path_index(self))
+
+    def reset_config(self, config_dict, usage_state_level="count",
+                     hist_sample_rate=1.0, lazy=False):
         assert usage_state_level in ["none", "count", "hist"]
+        assert 0.0 <= hist_sample_rate <= 1.0
+        if getattr(self, "_copies", None) is not None:
+            self._before_write()
         self._config_dict = {}
         self._usage_state = {}
         self._usage_state_level = usage_state_level
+        self._hist_sample_rate = hist_sample_rate
+        self._lazy = lazy
+        self._shared = set()
+        self._copies = None
+        if lazy:
+            # Nested dicts stay plain until __getitem__ reaches them and usage
+            # state is created on first read. Lists are copied so the source
+            # dict (possibly a cached document) is never mutated through us.
+            for k, v in config_dict.items():
+                self._config_dict[k] = deepcopy(v) if isinstance(v, list) else v
+            return
         for k in config_dict.keys():
             if isinstance(config_dict[k], dict):
                 self._config_dict[k] = Config(config_dict[k],
-                                              usage_state_level=usage_state_level)
+                                              usage_state_level=usage_state_level,
+                                              hist_sample_rate=hist_sample_rate)
+                self._config_dict[k]._parent = self
             else:
                 self._config_dict[k] = config_dict[k]
-                self._usage_state[k] = {"count": 0, "hist": []}
+                self._usage_state[k] = {"count": 0, "hist": {}}
 
     def __getattr__(self, key):
-        if key in ["_config_dict", "_usage_state_level", "_usage_state"]:
+        if key in _config_attrs:
             return super().__getattr__(key)
         return self.__getitem__(key)
     
     def __setattr__(self, key, value):
-        if key in ["_config_dict", "_usage_state_level", "_usage_state"]:
+        if key in _config_attrs:
             super().__setattr__(key, value)
             return
         self.__setitem__(key, value)
@@ -121,28 +266,46 @@ class Config(Mapping):
     def __getitem__(self, key):
         if key not in self._config_dict:
             raise ValueError("Key '{}' not in config: {}".format(key, self))
-        if not isinstance(self._config_dict[key], Config):
+        if key in self._shared:
+            value = self._unshare(key)
+        else:
+            value = self._config_dict[key]
+        if self._lazy and isinstance(value, _lazy_types):
+            value = Config(value,
+                           usage_state_level=self._usage_state_level,
+                           hist_sample_rate=self._hist_sample_rate,
+                           lazy=True)
+            value._parent = self
+            self._config_dict[key] = value
+        if not isinstance(value, Config):
             if self._usage_state_level == "none":
                 pass
-            elif self._usage_state_level == "count":
-                self._usage_state[key]["count"] += 1
-            elif self._usage_state_level == "hist":
-                self._usage_state[key]["count"] += 1
-                s = [(f"filename: {x.filename}, line: {x.lineno}, code: {x.code_context}")
-                     for x in inspect.stack()[1:]]
-                self._usage_state[key]["hist"].append(s)
             else:
-                raise ValueError()
-        return self._config_dict[key]
+                state = self._usage_state.get(key)
+                if state is None:
+                    state = self._usage_state[key] = {"count": 0, "hist": {}}
+                if self._usage_state_level == "count":
+                    state["count"] += 1
+                elif self._usage_state_level == "hist":
+                    state["count"] += 1
+                    record_call_site(state["hist"], sample_rate=self._hist_sample_rate)
+                else:
+                    raise ValueError()
+        return value
     
     def __setitem__(self, key, value):
+        self._before_write()
+        if key in self._shared:
+            self._drop_shared(key)
+        if isinstance(value, Config) and value._parent is None:
+            value._parent = self
         self._config_dict[key] = value
         if self._usage_state_level == "none":
             pass
         elif self._usage_state_level == "count":
             self._usage_state[key] = {"count": 1}
         elif self._usage_state_level == "hist":
-            self._usage_state[key] = {"count": 0, "hist": []}
+            self._usage_state[key] = {"count": 0, "hist": {}}
         else:
             raise ValueError()
 
@@ -158,30 +321,36 @@ class Config(Mapping):
         pprint.pprint(d)
 
     def __getstate__(self):
-        state = config_to_dict(self)
-        return state
+        return codec.encode(config_to_dict(self))
 
     def __setstate__(self, state):
-        self.reset_config(state, usage_state_level="none")
+        # bytes from codec.encode, or the nested dict older pickles hold
+        self._parent = None
+        if isinstance(state, dict):
+            self.reset_config(state, usage_state_level="none")
+        else:
+            self.reset_config(codec.decode(state), usage_state_level="none", lazy=True)
 
     def to_file(self, path):
         # dir_path = os.path.dirname(path)
         # os.makedirs(dir_path, exist_ok=True)
-        with fsspec.open(path, "w", auto_mkdir=True) as f:
-            yaml.dump(
-                config_to_dict(self),
-                f,
-                default_flow_style=False)
+        with rfs.open(path, "w") as f:
+            yaml_dump(config_to_dict(self), f)
             
     def __eq__(self, other):
+        # Lazy configs hold plain dicts and overlay views, so Configs also
+        # compare with other mappings.
+        if isinstance(other, (Config, FrozenConfig)):
+            other = other._config_dict
+        elif not isinstance(other, Mapping):
+            return NotImplemented
+        if len(self._config_dict) != len(other):
+            return False
         for k in self._config_dict.keys():
-            if k not in list(other._config_dict.keys()):
-                return False
-        for k in other._config_dict.keys():
-            if k not in list(self._config_dict.keys()):
+            if k not in other:
                 return False
         for k in self._config_dict.keys():
-            if not self._config_dict[k] == other._config_dict[k]:
+            if not self._config_dict[k] == other[k]:
                 return False
         return True
 
@@ -192,7 +361,92 @@ class Config(Mapping):
         return self.__str__()
 
 
-def _load_config(file_path):
+class FrozenConfig(Mapping):
+    # Immutable counterpart of Config without usage tracking. Instances are
+    # created by freeze_dict as generated subclasses whose __slots__ are the
+    # identifier-like keys, so `config.a.b` is a plain slot lookup.
+    __slots__ = ("_config_dict",)
+
+    def __new__(cls, config_dict={}):
+        return freeze_dict(config_to_dict(config_dict))
+
+    def thaw(self, usage_state_level="count"):
+        return Config(config_to_dict(self), usage_state_level=usage_state_level)
+
+    def freeze(self):
+        return self
+
+    def copy(self):
+        return self
+
+    def __getattr__(self, key):
+        if key.startswith("_"):
+            raise AttributeError(key)
+        return self.__getitem__(key)
+
+    def __setattr__(self, key, value):
+        raise TypeError("FrozenConfig is immutable, use thaw() to get a Config")
+
+    def __delattr__(self, key):
+        raise TypeError("FrozenConfig is immutable, use thaw() to get a Config")
+
+    def __getitem__(self, key):
+        if key not in self._config_dict:
+            raise ValueError("Key '{}' not in config: {}".format(key, self))
+        return self._config_dict[key]
+
+    def __contains__(self, key):
+        return key in self._config_dict
+
+    def __iter__(self):
+        return iter(self._config_dict)
+
+    def __len__(self):
+        return len(self._config_dict)
+
+    def __reduce__(self):
+        return (freeze_dict, (config_to_dict(self),))
+
+    pprint = Config.pprint
+    to_file = Config.to_file
+    __eq__ = Config.__eq__
+    __str__ = Config.__str__
+    __repr__ = Config.__repr__
+
+
+_frozen_classes = {}
+
+def _is_slot_key(k):
+    return isinstance(k, str) and k.isidentifier() \
+        and not k.startswith("_") and not hasattr(FrozenConfig, k)
+
+def _frozen_class(keys):
+    slots = tuple(k for k in keys if _is_slot_key(k))
+    cls = _frozen_classes.get(slots)
+    if cls is None:
+        cls = type("FrozenConfig", (FrozenConfig,),
+                   {"__slots__": slots, "__module__": __name__})
+        _frozen_classes[slots] = cls
+    return cls
+
+def freeze_dict(config_dict):
+    frozen_dict = {}
+    for k, v in config_dict.items():
+        if isinstance(v, dict):
+            frozen_dict[k] = freeze_dict(v)
+        else:
+            frozen_dict[k] = v
+    cls = _frozen_class(frozen_dict.keys())
+    obj = object.__new__(cls)
+    object.__setattr__(obj, "_config_dict", frozen_dict)
+    for k in cls.__slots__:
+        object.__setattr__(obj, k, frozen_dict[k])
+    return obj
+
+
+def _load_config(file_path, use_cache=True, copy=True):
+    if use_cache:
+        return load_yaml_cached(file_path + ".yaml", copy=copy)
     return load_yaml(file_path + ".yaml")
 
 def check_config_path(file_path):
@@ -205,7 +459,9 @@ def check_config_path(file_path):
     return True
 
 
-def load_config(file_path, usage_state_level="hist"):
+@timed("load_config")
+def load_config(file_path, usage_state_level="hist", hist_sample_rate=1.0,
+                frozen=False, use_cache=True, lazy=False):
     prefix = "/".join(file_path.split("/")[:-1])
     file_path = file_path.split("/")[-1]
 
@@ -220,11 +476,57 @@ def load_config(file_path, usage_state_level="hist"):
         sub_path = None
     file_path = file_paths[0]
     file_paths = file_path.split("+")
-    config = {}
-    for i in range(len(file_paths)):
-        _config = _load_config(os.path.join(prefix, file_paths[i]))
-        config = deep_update(config, _config)
+    # The layers are the cached documents themselves, the view never writes
+    # to them. Lazy configs copy what they materialize, otherwise the merged
+    # copy is built once here.
+    layers = [_load_config(os.path.join(prefix, p), use_cache, copy=False)
+              for p in file_paths]
+    mask = None
     if sub_path is not None:
-        _config = _load_config(os.path.join(prefix, sub_path))
-        config = deep_filter(config, _config)
-    return Config(config, usage_state_level=usage_state_level)
\ No newline at end of file
+        mask = _load_config(os.path.join(prefix, sub_path), use_cache, copy=False)
+    config = OverlayView(layers, mask)
+    if frozen:
+        return freeze_dict(config.to_dict())
+    if lazy:
+        return Config(config,
+                      usage_state_level=usage_state_level,
+                      hist_sample_rate=hist_sample_rate,
+                      lazy=True)
+    return Config(config.to_dict(),
+                  usage_state_level=usage_state_level,
+                  hist_sample_rate=hist_sample_rate)
+
+
+def load_config_shared(file_path, usage_state_level="hist", hist_sample_rate=1.0,
+                       frozen=False, lazy=False, timeout=600, key=None):
+    # load_config for DDP: local rank 0 loads the config and publishes its
+    # encoding in shared memory, the other ranks of the node map it instead
+    # of fetching and parsing the file themselves. They fall back to
+    # load_config after timeout seconds. key names the shared file and
+    # defaults to one derived from file_path and dist._get_run_id(), which
+    # differs between launches, so a file left by an earlier launch is never
+    # read. Launchers whose ranks are not started by one common process
+    # need a key of their own that changes with every launch. The last
+    # local rank to read the shared file removes it.
+    if dist._get_local_world_size() <= 1:
+        return load_config(file_path, usage_state_level=usage_state_level,
+                           hist_sample_rate=hist_sample_rate, frozen=frozen, lazy=lazy)
+    if key is None:
+        key = hashlib.sha1("{}|{}".format(file_path, dist._get_run_id())
+                           .encode("utf-8")).hexdigest()[:16]
+    shm_path = os.path.join(codec.get_shm_dir(), "rena-config-{}".format(key))
+    if dist._get_local_rank() == 0:
+        config_dict = config_to_dict(load_config(file_path, usage_state_level="none"))
+        codec.publish(shm_path, codec.encode(config_dict))
+    else:
+        config_dict = codec.read_published(shm_path, timeout=timeout,
+                                           num_readers=dist._get_local_world_size() - 1)
+        if config_dict is None:
+            print("No shared config at {}, loading {}".format(shm_path, file_path))
+            config_dict = config_to_dict(load_config(file_path, usage_state_level="none"))
+    if frozen:
+        return freeze_dict(config_dict)
+    return Config(config_dict,
+                  usage_state_level=usage_state_level,
+                  hist_sample_rate=hist_sample_rate,
+                  lazy=lazy)
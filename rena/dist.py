@@ -16,6 +16,39 @@ def _get_rank() -> int:
 
 local_rank = _get_rank()
 
+def _get_local_rank() -> int:
+    # rank within this node, unlike _get_rank which prefers the global RANK
+    for key in ("LOCAL_RANK", "SLURM_LOCALID"):
+        rank = os.environ.get(key)
+        if rank is not None:
+            return int(rank)
+    return 0
+
+def _get_local_world_size() -> int:
+    # SLURM_NTASKS_PER_NODE looks like "8" or "8(x2)"
+    for key in ("LOCAL_WORLD_SIZE", "SLURM_NTASKS_PER_NODE"):
+        size = os.environ.get(key)
+        if size is not None:
+            return int(size.split("(")[0])
+    return 1
+
+def _get_process_start(pid) -> str:
+    # start time of pid in clock ticks since boot, "" where /proc is missing
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            return f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return ""
+
+def _get_run_id() -> str:
+    # Same for all local ranks of one launch and different for every other
+    # launch, used to name shared files: the process that started the ranks
+    # (torchrun agent, slurmstepd) by pid and start time, as pids are
+    # reused, plus the elastic restart count and the slurm job and step.
+    ppid = os.getppid()
+    keys = ("TORCHELASTIC_RESTART_COUNT", "SLURM_JOB_ID", "SLURM_STEP_ID")
+    return "-".join([str(ppid), _get_process_start(ppid)] + [os.environ.get(key, "") for key in keys])
+
 def rank_zero_only(fn: Callable) -> Callable:
     """Function that can be used as a decorator to enable a function/method being called only on rank 0."""
 
@@ -1,25 +1,33 @@
 import os
 import random
-import fsspec
 import pickle
 import time
+import uuid
 import shutil
-from functools import wraps
-from copy import deepcopy
+import multiprocessing
+from functools import wraps, partial
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-from .config import load_config, config_to_dict, flatten_config, recover_flattened_config, Config
-from .utils import save_yaml, load_yaml, get_dt_for_file_name
-import rfs
-import dist
+from .config import load_config, config_to_dict, flatten_config, config_hash
+from .config import config_path_index
+from .utils import save_yaml, yaml_load, yaml_dump, get_dt_for_file_name
+from .search import SearchSpace
+from .upload import UploadQueue, upload_dir
+from .summary import load_result_table, load_indexed_result_table
+from .results_index import ResultsIndexWriter, make_record
+from .lease import LeaseKeeper, make_lease, dump_lease, read_lease, lease_expired, reclaim_lease
+from .lease import owns_lease, release_lease, worker_id
+from . import rfs, instrument
+from . import dist
 
 @dist.rank_zero_only
+@instrument.timed("global_lock.wait")
 def require_global_lock():
     while True:
         print("Waiting for global lock")
         time.sleep(random.random()*5 + 5)
         if not rfs.isfile(dist._global_lock_file):
-            with fsspec.open(dist._global_lock_file, "w") as f:
-                f.write("Locked")
+            rfs.pipe(dist._global_lock_file, "Locked")
             break
         else:
             continue
@@ -31,52 +39,103 @@ def release_global_lock():
     rfs.rm(dist._global_lock_file)
     print("global lock released")
 
-def get_file_id(file_name_func):
-    i = 0
-    while(rfs.isfile(file_name_func(i))):
-        i += 1
-    return i
+def get_file_ids(prefix):
+    try:
+        names = [os.path.basename(p.rstrip("/")) for p in rfs.ls(prefix)]
+    except FileNotFoundError:
+        return []
+    return sorted(int(name) for name in names if name.isdigit())
+
+def get_config_index_dir(prefix):
+    return os.path.join(prefix, "config_index")
+
+def load_config_hashes(prefix):
+    # The index is a folder of shards, one per generation run, with
+    # "<id> <config_hash>" lines. Shards are never rewritten.
+    index_dir = get_config_index_dir(prefix)
+    try:
+        # ls drops the protocol on most backends, rebuild the urls
+        shard_paths = [os.path.join(index_dir, os.path.basename(p.rstrip("/")))
+                       for p in rfs.ls(index_dir)]
+    except FileNotFoundError:
+        return {}
+    hashes = {}
+    docs = rfs.cat_many(shard_paths)
+    for shard_path in shard_paths:
+        doc = docs[shard_path]
+        if isinstance(doc, Exception):
+            raise doc
+        for line in doc.decode("utf-8").splitlines():
+            if line.strip():
+                file_id, h = line.split()
+                hashes[int(file_id)] = h
+    return hashes
+
+def save_config_hashes(prefix, hashes):
+    if len(hashes) == 0:
+        return
+    shard_name = "{}-{}.txt".format(int(time.time() * 1000), uuid.uuid4().hex[:8])
+    rfs.pipe(os.path.join(get_config_index_dir(prefix), shard_name),
+             "".join("{} {}\n".format(file_id, hashes[file_id])
+                     for file_id in sorted(hashes.keys())))
 
 def generate_random_config_search(base_config_path,
                                   search_config_path,
                                   prefix,
                                   num,
-                                  check_duplicate=True):
+                                  check_duplicate=True,
+                                  mode="random",
+                                  seed=None):
     
-    base_config = load_config(base_config_path)
+    base_config = load_config(base_config_path, usage_state_level="none")
     search_config = load_config(search_config_path)
     flat_base_config = config_to_dict(flatten_config(base_config))
     flat_search_config = config_to_dict(flatten_config(search_config))
+    for k in flat_search_config.keys():
+        assert isinstance(flat_search_config[k], list)
+        assert k in flat_base_config
+    space = SearchSpace(flat_search_config)
+    path_index = config_path_index(base_config)
     
     def file_name_func(i):
         return os.path.join(prefix, "{}".format(i), "config.yaml")
     
-    start_id = get_file_id(file_name_func)
-    existed_configs = [load_config(file_name_func(i)) for i in range(start_id)]
-    
+    # ids are only taken for real by the exclusive create of <id>/config.yaml
+    existed_ids = get_file_ids(prefix)
+    start_id = existed_ids[-1] + 1 if len(existed_ids) > 0 else 0
+    existed_hashes = load_config_hashes(prefix)
+    new_hashes = {}
+    for i in existed_ids:
+        # trials generated before the index existed
+        if i not in existed_hashes:
+            new_hashes[i] = config_hash(
+                load_config(file_name_func(i), usage_state_level="none"))
+    hash_set = set(existed_hashes.values()) | set(new_hashes.values())
+
     file_id = start_id
     cnt = 0
-    for _ in range(start_id, start_id + num):
-        _flat_base_config = deepcopy(flat_base_config)
-        for k in flat_search_config.keys():
-            assert isinstance(flat_search_config[k], list)
-            assert k in flat_base_config
-            _flat_base_config[k] = random.choice(flat_search_config[k])
-        _res_config = recover_flattened_config(Config(_flat_base_config))
-        if check_duplicate:
-            found = False
-            for c in existed_configs:
-                if c == _res_config:
-                    found = True
-                    break
-            if found:
-                continue
-        existed_configs.append(_res_config)
-        file_save_path = file_name_func(file_id)
-        _res_config.to_file(file_save_path)
+    for point_index in space.sample(mode=mode, seed=seed):
+        if cnt >= num:
+            break
+        # copies share the base config, setting a key copies only its path
+        _res_config = base_config.copy()
+        flat_view = _res_config.flat_view(path_index)
+        for k, v in space.point(point_index).items():
+            flat_view[k] = v
+        h = config_hash(_res_config)
+        if check_duplicate and h in hash_set:
+            continue
+        hash_set.add(h)
+        config_text = yaml_dump(config_to_dict(_res_config))
+        # another generator may have taken the id since the listing
+        while not rfs.create_exclusive(file_name_func(file_id), config_text):
+            file_id += 1
+        new_hashes[file_id] = h
         file_id += 1
         cnt += 1
-    print("Generated {} configs".format(cnt))
+    save_config_hashes(prefix, new_hashes)
+    print("Generated {} configs, {} of {} search points in prefix ({:.1%})".format(
+        cnt, len(hash_set), space.size, space.coverage(min(len(hash_set), space.size))))
 
 def get_config_file_path(config_dir):
     return os.path.join(config_dir, "config.yaml")
@@ -87,140 +146,468 @@ def get_finished_tag_path(config_dir):
 def get_lock_tag_path(config_dir):
     return os.path.join(config_dir, "lock.tag")
 
+def get_failed_tag_path(config_dir):
+    return os.path.join(config_dir, "failed.tag")
+
+def get_failures_path(config_dir):
+    return os.path.join(config_dir, "failures.yaml")
+
 def check_finished(config_dir):
     config_path = get_config_file_path(config_dir)
     lock_path = get_lock_tag_path(config_dir)
     finish_tag_path = get_finished_tag_path(config_dir)
-    return rfs.isfile(finish_tag_path) \
-        and not rfs.isfile(lock_path) \
-            and rfs.isfile(config_path)
+    finished, locked, has_config = rfs.isfile_many([finish_tag_path, lock_path, config_path])
+    return finished and not locked and has_config
 
 def check_todo(config_dir):
     config_path = get_config_file_path(config_dir)
     lock_path = get_lock_tag_path(config_dir)
     finish_tag_path = get_finished_tag_path(config_dir)
-    return not rfs.isfile(lock_path) \
-        and not rfs.isfile(finish_tag_path) \
-            and rfs.isfile(config_path)
+    finished, locked, has_config = rfs.isfile_many([finish_tag_path, lock_path, config_path])
+    return not locked and not finished and has_config
     
     
-def get_config_dirs(prefix, mode="all", find_one=False):
-    config_dirs = rfs.ls(prefix)
-    res_config_dirs = []
-    for config_dir in config_dirs:
-        config_path = get_config_file_path(config_dir)
-        if not rfs.isfile(config_path):
-            continue
-        if mode == "all":
-            if find_one:
-                return config_dir
-            res_config_dirs.append(config_dir)
-        elif mode == "finished":
-            if check_finished(config_dir):
-                if find_one:
-                    return config_dir
-                res_config_dirs.append(config_dir)
-        elif mode == "todo":
-            if check_todo(config_dir):
-                if find_one:
-                    return config_dir
-                res_config_dirs.append(config_dir)
-        elif mode == "locked":
-            if rfs.isfile(get_lock_tag_path(config_dir)):
-                if find_one:
-                    return config_dir
-                res_config_dirs.append(config_dir)
-        else:
+def _trial_sort_key(name):
+    return not name.isdigit(), int(name) if name.isdigit() else 0, name
+
+class SweepSnapshot:
+    # State of every trial under a prefix, built from one recursive listing
+    # instead of isfile calls per trial.
+
+    def __init__(self, prefix, file_paths):
+        self.prefix = prefix
+        self.trials = {}
+        for file_path in file_paths:
+            parts = file_path.split("/")
+            if len(parts) == 2:
+                self.trials.setdefault(parts[0], set()).add(parts[1])
+
+    def config_dir(self, name):
+        return os.path.join(self.prefix, name)
+
+    def state(self, name):
+        files = self.trials.get(name, ())
+        if "config.yaml" not in files:
+            return None
+        if "lock.tag" in files:
+            return "locked"
+        if "finished.tag" in files:
+            return "finished"
+        if "failed.tag" in files:
+            return "failed"
+        return "todo"
+
+    def names(self, mode="all"):
+        if mode not in ["all", "finished", "todo", "locked", "failed"]:
             raise ValueError()
+        res = []
+        for name in sorted(self.trials.keys(), key=_trial_sort_key):
+            state = self.state(name)
+            if state is None:
+                continue
+            if mode == "all" or mode == state:
+                res.append(name)
+        return res
+
+    def config_dirs(self, mode="all"):
+        return [self.config_dir(name) for name in self.names(mode)]
+
+    def counts(self):
+        res = {"todo": 0, "locked": 0, "finished": 0, "failed": 0}
+        for name in self.names():
+            res[self.state(name)] += 1
+        return res
+
+
+@instrument.timed("get_snapshot")
+def get_snapshot(prefix):
+    try:
+        file_paths = rfs.find(prefix)
+    except FileNotFoundError:
+        file_paths = []
+    return SweepSnapshot(prefix, file_paths)
+
+def get_config_dirs(prefix, mode="all", find_one=False, snapshot=None, index=None):
+    # With a ResultsIndex, finished trials come from a refresh of the index
+    # instead of a listing of the whole prefix. The index only records
+    # finished trials, other modes still use a snapshot.
+    if index is not None and mode == "finished":
+        index.refresh()
+        res_config_dirs = sorted(index.config_dirs("finished"),
+                                 key=lambda d: _trial_sort_key(os.path.basename(d.rstrip("/"))))
+    else:
+        if snapshot is None:
+            snapshot = get_snapshot(prefix)
+        res_config_dirs = snapshot.config_dirs(mode)
     if find_one:
-        return None
+        return res_config_dirs[0] if len(res_config_dirs) > 0 else None
     else:
         return res_config_dirs
 
 @dist.rank_zero_only
-def clear_locks(prefix):
+def clear_locks(prefix, expired_only=False, confirm=True):
     locked_dirs = get_config_dirs(prefix, mode="locked")
+    if expired_only:
+        now = time.time()
+        locked_dirs = [d for d in locked_dirs
+                       if lease_expired(read_lease(get_lock_tag_path(d)), now)]
     print("Locked dirs: {}".format(locked_dirs))
-    cmd = input("Clear locks?: (Y)")
+    cmd = input("Clear locks?: (Y)") if confirm else "Y"
     if cmd == "Y":
-        for config_dir in locked_dirs:
-            rfs.rm(get_lock_tag_path(config_dir))
+        rfs.rm_many([get_lock_tag_path(config_dir) for config_dir in locked_dirs])
         print("Unlocked")
     else:
         print("Keep lock")
     
-def remote_exp_func(fn, base_folder):
+def check_results(results):
+    assert isinstance(results, dict) and isinstance(results.get("metrics"), dict)
+
+def save_trial_results(results, base_folder, result_cache=None, trial_hash=None,
+                       progress=None, remove_local=True):
+    # Saves in stages that are each safe to repeat. progress (a dict) records
+    # the stages that are done and the remote persistent_dir, so a retry
+    # passing the same dict redoes only the stage that failed and uploads to
+    # the same place. The local persistent_dir is deleted at the end if
+    # remove_local, otherwise by the caller with remove_persistent_dir.
+    progress = {} if progress is None else progress
+    if "results" not in progress:
+        with rfs.open(os.path.join(base_folder, "results.pkl"), "wb") as f:
+            pickle.dump(results, f)
+        save_yaml(results["metrics"], os.path.join(base_folder, "metrics.yaml"))
+        progress["results"] = True
+    if "persistent_dir" in results:
+        persistent_dir_path = progress.setdefault(
+            "persistent_dir", os.path.join("s3://tmp/persistent_dirs/", get_dt_for_file_name()))
+        if "upload" not in progress:
+            upload_dir(results["persistent_dir"], persistent_dir_path)
+            progress["upload"] = True
+        if "link" not in progress:
+            rfs.pipe(os.path.join(base_folder, "persistent_dir_link.txt"), persistent_dir_path)
+            progress["link"] = True
+    if result_cache is not None and "cache" not in progress:
+        result_cache.store(trial_hash, base_folder)
+        progress["cache"] = True
+    if remove_local:
+        remove_persistent_dir(results)
+
+def remove_persistent_dir(results):
+    local_dir_path = results.get("persistent_dir")
+    if local_dir_path is not None and os.path.isdir(local_dir_path):
+        shutil.rmtree(local_dir_path)
+        print("Persistent dir uploaded, local files deleted")
+
+def save_timings(stats, config_dir):
+    # per-trial instrument stats, next to metrics.yaml
+    if stats is not None:
+        save_yaml(stats, os.path.join(config_dir, "timings.yaml"))
+
+def _save_with_timings(results, base_folder, result_cache, trial_hash, stats, progress):
+    with instrument.collect(stats), instrument.timer("remote_exp_func.save"):
+        save_trial_results(results, base_folder, result_cache, trial_hash, progress)
+    save_timings(stats, base_folder)
+
+def remote_exp_func(fn, base_folder, upload_queue=None, result_cache=None):
+    # With an UploadQueue the results are saved in the background and
+    # wrapped_fn returns as soon as fn does. With a ResultCache, keyed by the
+    # Config passed as first argument, fn is skipped when the config already
+    # has stored results.
     
     @wraps(fn)
     def wrapped_fn(*args, **kwargs):
         os.makedirs(base_folder, exist_ok=True)
-        results = fn(*args, **kwargs)
-        assert isinstance(results, dict) and isinstance(results.get("metrics"), dict)
-        results_path = os.path.join(base_folder, "results.pkl")
-        metrics_path = os.path.join(base_folder, "metrics.yaml")
-        with fsspec.open(results_path, "wb") as f:
-            pickle.dump(results, f)
-        save_yaml(results["metrics"], metrics_path)
-        if "persistent_dir" in results:
-            persistent_dir_path = os.path.join("s3://tmp/persistent_dirs/",
-                                               get_dt_for_file_name())
-            local_dir_path = results["persistent_dir"]
-            rfs.put(local_dir_path, persistent_dir_path, recursive=True)
-            shutil.rmtree(local_dir_path)
-            persistent_dir_link = os.path.join(base_folder, "persistent_dir_link.txt")
-            with fsspec.open(persistent_dir_link, "w") as f:
-                f.write(persistent_dir_path)
-            print("Persistent dir uploaded, local files deleted")
+        trial_hash = None
+        if result_cache is not None:
+            trial_hash = config_hash(args[0])
+            if result_cache.restore(trial_hash, base_folder) is not None:
+                print("Reused cached results for {}".format(base_folder))
+                return result_cache.load_results(trial_hash)
+        stats = {} if instrument.enabled else None
+        with instrument.collect(stats), instrument.timer("remote_exp_func.func"):
+            results = fn(*args, **kwargs)
+        check_results(results)
+        if upload_queue is None:
+            _save_with_timings(results, base_folder, result_cache, trial_hash, stats, {})
+        else:
+            upload_queue.submit(_save_with_timings, results, base_folder,
+                                result_cache, trial_hash, stats, {})
         return results
 
     return wrapped_fn
 
-def launch_search(func, prefix):
+# Claim order is drawn on the prefetch thread while func runs, from an RNG
+# of its own so trials that seed the global random module stay reproducible.
+_claim_rng = random.Random()
+
+def claim_trial(config_dir, lease_ttl=600):
+    # lock.tag is created exclusively, so exactly one worker wins a trial
+    # without any global lock. It holds a lease that LeaseKeeper renews.
+    lock_path = get_lock_tag_path(config_dir)
+    if not rfs.create_exclusive(lock_path, dump_lease(make_lease(lease_ttl))):
+        return False
+    # finished.tag / failed.tag are written before lock.tag is removed, so a
+    # trial that finished or failed after our snapshot is caught here.
+    if any(rfs.isfile_many([get_finished_tag_path(config_dir), get_failed_tag_path(config_dir)])):
+        rfs.rm(lock_path)
+        return False
+    return True
+
+def reclaim_expired_trial(snapshot, lease_ttl=600):
+    # Takes over a trial whose owner stopped renewing its lease.
+    names = snapshot.names("locked")
+    _claim_rng.shuffle(names)
+    now = time.time()
+    for name in names:
+        config_dir = snapshot.config_dir(name)
+        lock_path = get_lock_tag_path(config_dir)
+        lease = read_lease(lock_path)
+        if not lease_expired(lease, now):
+            continue
+        if "finished.tag" in snapshot.trials[name] or "failed.tag" in snapshot.trials[name]:
+            # the owner died between writing finished.tag (failed.tag) and unlocking
+            try:
+                rfs.rm(lock_path)
+            except FileNotFoundError:
+                pass
+            continue
+        if reclaim_lease(lock_path, lease, lease_ttl):
+            # as in claim_trial, the trial may have finished since the snapshot
+            if rfs.isfile(get_finished_tag_path(config_dir)):
+                release_lease(lock_path)
+                continue
+            print("Reclaimed expired lease of {} on {}".format(lease.get("owner"), config_dir))
+            return config_dir
+    return None
+
+def claim_next_trial(prefix, snapshot=None, lease_ttl=600):
+    if snapshot is None:
+        snapshot = get_snapshot(prefix)
+    todo_dirs = snapshot.config_dirs("todo")
+    # workers sharing a prefix try the todo trials in different orders
+    _claim_rng.shuffle(todo_dirs)
+    for config_dir in todo_dirs:
+        if claim_trial(config_dir, lease_ttl):
+            return config_dir
+    return reclaim_expired_trial(snapshot, lease_ttl)
+
+def finish_trial(config_dir):
+    rfs.pipe(get_finished_tag_path(config_dir), "Finished")
+    release_lease(get_lock_tag_path(config_dir))
+
+def _prefetch_trial(prefix, lease_ttl, lease_keeper, result_cache=None, index_writer=None):
+    # Trials with cached results are finished right here and never take a slot.
     while True:
-        require_global_lock()
-        config_dir = get_config_dirs(prefix, mode="todo", find_one=True)
-        if config_dir is None:
-            print("No config_dir found")
-            time.sleep(60)
+        stats = {} if instrument.enabled else None
+        with instrument.collect(stats):
+            with instrument.timer("launch_search.claim"):
+                config_dir = claim_next_trial(prefix, lease_ttl=lease_ttl)
+            if config_dir is None:
+                return None
+            lease_path = get_lock_tag_path(config_dir)
+            lease_keeper.add(lease_path)
+            config = load_config(get_config_file_path(config_dir))
+            trial_hash = config_hash(config)
+            metrics = None
+            if result_cache is not None:
+                with instrument.timer("launch_search.restore"):
+                    metrics = result_cache.restore(trial_hash, config_dir)
+        if metrics is not None:
+            print("Reused cached results for {}".format(config_dir))
+            lease_keeper.remove(lease_path)
+            finish_trial(config_dir)
+            if index_writer is not None:
+                index_writer.append(make_record(config_dir, "finished", trial_hash, metrics))
             continue
-        with fsspec.open(get_lock_tag_path(config_dir), "w") as f:
-            f.write("Running")
-        release_global_lock()
-            
-        print("Running config: {}".format(config_dir))
-        config = load_config(get_config_file_path(config_dir))
-        
-        wrapped_func = remote_exp_func(func, config_dir)
-        results = wrapped_func(config)
-        
-        # ##############
-        # # save results
-        # results_path = os.path.join(config_dir, "results.pkl")
-        # metrics_path = os.path.join(config_dir, "metrics.yaml")
-        # with fsspec.open(results_path, "wb") as f:
-        #     pickle.dump(results, f)
-        # save_yaml(results["metrics"], metrics_path)
-        # if "persistent_dir" in results:
-        #     persistent_dir_path = os.path.join("s3://tmp/persistent_dirs/",
-        #                                        get_dt_for_file_name())
-        #     local_dir_path = results["persistent_dir"]
-        #     rfs.put(local_dir_path, persistent_dir_path, recursive=True)
-        #     shutil.rmtree(local_dir_path)
-        #     persistent_dir_link = os.path.join(config_dir, "persistent_dir_link.txt")
-        #     with fsspec.open(persistent_dir_link, "w") as f:
-        #         f.write(persistent_dir_path)
-        #     print("Persistent dir uploaded, local files deleted")
-        ##############
-            
-        rfs.rm(get_lock_tag_path(config_dir))
-        with fsspec.open(get_finished_tag_path(config_dir), "w") as f:
-            f.write("Finished")
-            
-def summarize_search(prefix):
-    finished_config_dirs = get_config_dirs(prefix, mode="finished")
-    for i, config_dir in enumerate(finished_config_dirs):
-        metrics_path = os.path.join(config_dir, "metrics.yaml")
-        config_path = os.path.join(config_dir, "config.yaml")
-        metrics = load_yaml(metrics_path)
-        config = load_yaml(config_path)
-        print(i, metrics, config)
\ No newline at end of file
+        return config_dir, config, trial_hash, stats
+
+def _run_trial(func, config_dir, config, trial_hash=None, instrumented=False, profiler=None):
+    # Only runs func, saving results is left to the UploadQueue of
+    # launch_search so the slot is free while they upload. Returns the
+    # results and, if instrumented, the stats collected while func ran.
+    print("Running config: {}".format(config_dir))
+    os.makedirs(config_dir, exist_ok=True)
+    # spawned workers do not see instrument.enable() of the parent
+    instrument.enable(instrumented)
+    stats = {} if instrumented else None
+    with instrument.collect(stats), instrument.timer("launch_search.func"):
+        if profiler is not None:
+            with profiler(config_dir):
+                results = func(config)
+        else:
+            results = func(config)
+    check_results(results)
+    return results, stats
+
+def _save_and_finish_trial(results, config_dir, lease_keeper, index_writer=None,
+                           trial_hash=None, result_cache=None, stats=None, progress=None):
+    # Retried by the UploadQueue with the same progress dict, see
+    # save_trial_results. The local persistent_dir is only deleted once the
+    # trial is finished and indexed.
+    progress = {} if progress is None else progress
+    lock_path = get_lock_tag_path(config_dir)
+    if "finished" not in progress and (lock_path in lease_keeper.lost
+                                       or not owns_lease(lock_path)):
+        # another worker reclaimed the trial and writes its own results
+        lease_keeper.remove(lock_path)
+        print("Lease on {} was lost, results dropped".format(config_dir))
+        return
+    with instrument.collect(stats):
+        with instrument.timer("launch_search.save"):
+            save_trial_results(results, config_dir, result_cache, trial_hash,
+                               progress, remove_local=False)
+        save_timings(stats, config_dir)
+        if "finished" not in progress:
+            lease_keeper.remove(lock_path)
+            with instrument.timer("launch_search.finish"):
+                finish_trial(config_dir)
+            progress["finished"] = True
+    if index_writer is not None and "indexed" not in progress:
+        index_writer.append(make_record(config_dir, "finished", trial_hash,
+                                        results["metrics"]))
+        progress["indexed"] = True
+    remove_persistent_dir(results)
+
+def record_failure(config_dir, error, max_attempts=3):
+    # Appends error to the trial's failures.yaml. Once it has failed
+    # max_attempts times failed.tag is written and the trial leaves the todo
+    # pool; returns whether that happened.
+    failures_path = get_failures_path(config_dir)
+    try:
+        failures = yaml_load(rfs.cat(failures_path).decode("utf-8")) or []
+    except FileNotFoundError:
+        failures = []
+    failures.append({"owner": worker_id, "error": repr(error), "time": time.time()})
+    rfs.pipe(failures_path, yaml_dump(failures))
+    if len(failures) < max_attempts:
+        return False
+    rfs.pipe(get_failed_tag_path(config_dir), "Failed")
+    return True
+
+def _release_failed_trial(future, config_dir, lease_keeper, max_attempts=3):
+    # for trials whose func or upload failed: the failure is recorded and the
+    # trial unlocked, so it is retried until it has failed max_attempts times
+    if future.exception() is None:
+        return
+    lock_path = get_lock_tag_path(config_dir)
+    lease_keeper.remove(lock_path)
+    try:
+        if owns_lease(lock_path):
+            if record_failure(config_dir, future.exception(), max_attempts):
+                print("Trial {} failed {} times, giving up".format(config_dir, max_attempts))
+            release_lease(lock_path)
+    except Exception as e:
+        # the lease expires and the trial is reclaimed instead
+        print("Could not record failure of {}: {!r}".format(config_dir, e))
+
+def _release_prefetched_trial(future, lease_keeper):
+    # a trial that was claimed but never run goes back to todo
+    if future.cancelled() or future.exception() is not None or future.result() is None:
+        return
+    lock_path = get_lock_tag_path(future.result()[0])
+    lease_keeper.remove(lock_path)
+    release_lease(lock_path)
+
+def _run_trial_inline(func, *args):
+    future = Future()
+    try:
+        future.set_result(_run_trial(func, *args))
+    except BaseException as e:
+        future.set_exception(e)
+    return future
+
+def launch_search(func, prefix, slots=1, poll_interval=60, lease_ttl=600,
+                  max_pending_uploads=8, upload_retries=3, write_index=True,
+                  result_cache=None, profiler=None, exit_when_idle=False, max_attempts=3):
+    # Runs up to `slots` trials at once. With slots > 1 trials run in a
+    # process pool, so func must be picklable. The next trial is claimed and
+    # its config loaded in a background thread while trials are running.
+    # Results are uploaded from a bounded UploadQueue and finished.tag is
+    # written only after they are saved. With write_index each finished trial
+    # is also appended to this worker's shard of the ResultsIndex. With a
+    # ResultCache, trials whose config already has results are not rerun.
+    # With instrumentation enabled each trial gets a timings.yaml, and
+    # profiler (e.g. instrument.cprofile) is called with the config_dir and
+    # entered around func. With exit_when_idle it returns once there is
+    # nothing left to claim instead of polling for new trials. A trial whose
+    # func or upload fails is retried until it failed max_attempts times,
+    # then marked with failed.tag (see record_failure).
+    if slots > 1:
+        # spawn, as the lease and prefetch threads make fork unsafe
+        pool = ProcessPoolExecutor(slots, mp_context=multiprocessing.get_context("spawn"))
+    else:
+        pool = None
+    prefetcher = ThreadPoolExecutor(1, thread_name_prefix="rena-prefetch")
+    upload_queue = UploadQueue(max_pending=max_pending_uploads, retries=upload_retries)
+    index_writer = ResultsIndexWriter(prefix) if write_index else None
+    running = {}
+    with LeaseKeeper(ttl=lease_ttl) as lease_keeper:
+        next_trial = prefetcher.submit(_prefetch_trial, prefix, lease_ttl, lease_keeper,
+                                       result_cache, index_writer)
+        try:
+            while True:
+                if len(running) < slots:
+                    with instrument.timer("launch_search.wait_prefetch"):
+                        trial = next_trial.result()
+                    if trial is not None:
+                        next_trial = prefetcher.submit(_prefetch_trial, prefix, lease_ttl,
+                                                       lease_keeper, result_cache,
+                                                       index_writer)
+                        config_dir, config, trial_hash, stats = trial
+                        args = (config_dir, config, trial_hash, instrument.enabled, profiler)
+                        if pool is None:
+                            future = _run_trial_inline(func, *args)
+                        else:
+                            future = pool.submit(_run_trial, func, *args)
+                        running[future] = config_dir, trial_hash, stats
+                        continue
+                    if len(running) == 0:
+                        print("No config_dir found")
+                        if exit_when_idle:
+                            break
+                        with instrument.timer("launch_search.idle"):
+                            time.sleep(poll_interval)
+                        next_trial = prefetcher.submit(_prefetch_trial, prefix, lease_ttl,
+                                                       lease_keeper, result_cache,
+                                                       index_writer)
+                        continue
+                with instrument.timer("launch_search.wait_trials"):
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    config_dir, trial_hash, stats = running.pop(future)
+                    if isinstance(future.exception(), Exception):
+                        # one failing config must not take the other slots down
+                        print("Trial {} failed: {!r}".format(config_dir, future.exception()))
+                        _release_failed_trial(future, config_dir, lease_keeper, max_attempts)
+                        continue
+                    results, func_stats = future.result()
+                    if stats is not None and func_stats is not None:
+                        instrument.merge(stats, func_stats)
+                    with instrument.timer("launch_search.wait_upload_slot"):
+                        upload = upload_queue.submit(_save_and_finish_trial, results,
+                                                     config_dir, lease_keeper, index_writer,
+                                                     trial_hash, result_cache, stats, {})
+                    upload.add_done_callback(
+                        partial(_release_failed_trial, config_dir=config_dir,
+                                lease_keeper=lease_keeper, max_attempts=max_attempts))
+                if next_trial.done() and next_trial.result() is None:
+                    next_trial = prefetcher.submit(_prefetch_trial, prefix, lease_ttl,
+                                                   lease_keeper, result_cache, index_writer)
+        finally:
+            prefetcher.shutdown(wait=True)
+            _release_prefetched_trial(next_trial, lease_keeper)
+            if pool is not None:
+                pool.shutdown(wait=True)
+            upload_queue.close()
+
+def summarize_search(prefix, verbose=True, max_workers=32, index=None):
+    # Fetches every finished trial's metrics.yaml and config.yaml
+    # concurrently and returns them as a ResultTable. With a ResultsIndex
+    # only trials finished since its last refresh are read.
+    if index is not None:
+        table = load_indexed_result_table(index)
+    else:
+        finished_config_dirs = get_config_dirs(prefix, mode="finished")
+        table = load_result_table(finished_config_dirs, max_workers=max_workers)
+    if verbose:
+        for i, row in enumerate(table.rows()):
+            print(i, row)
+    return table
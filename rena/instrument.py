@@ -0,0 +1,145 @@
+import os
+import time
+import marshal
+import cProfile
+import threading
+import fsspec
+from functools import wraps
+
+# Timers and counters for rfs, YAML and launch_search phases. Off unless
+# RENA_INSTRUMENT is set or enable() is called; disabled, a timed call
+# costs one flag check. Stats are {name: {"count": n, "seconds": s}}, kept
+# process-wide and, inside collect(stats), also added to stats for the
+# calling thread, which is how a trial gets its own timings.
+enabled = os.environ.get("RENA_INSTRUMENT", "0") not in ("", "0")
+
+_stats = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class _Null:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_null = _Null()
+
+
+def enable(flag=True):
+    global enabled
+    enabled = flag
+
+def _add(stats, name, seconds, n):
+    entry = stats.get(name)
+    if entry is None:
+        entry = stats[name] = {"count": 0, "seconds": 0.0}
+    entry["count"] += n
+    entry["seconds"] += seconds
+
+def record(name, seconds, n=1):
+    with _lock:
+        _add(_stats, name, seconds, n)
+    local = getattr(_local, "stats", None)
+    if local is not None:
+        _add(local, name, seconds, n)
+
+def count(name, n=1):
+    if enabled:
+        record(name, 0.0, n)
+
+def merge(stats, other):
+    for name, entry in other.items():
+        _add(stats, name, entry["seconds"], entry["count"])
+    return stats
+
+
+class _Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+def timer(name):
+    if not enabled:
+        return _null
+    return _Timer(name)
+
+def timed(name):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapped(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapped
+    return decorator
+
+
+class _Collect:
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __enter__(self):
+        self.prev = getattr(_local, "stats", None)
+        _local.stats = self.stats
+        return self.stats
+
+    def __exit__(self, *args):
+        _local.stats = self.prev
+        return False
+
+def collect(stats):
+    if stats is None or not enabled:
+        return _null
+    return _Collect(stats)
+
+
+def get_stats():
+    with _lock:
+        return {name: dict(entry) for name, entry in _stats.items()}
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+def report(stats=None):
+    stats = get_stats() if stats is None else stats
+    for name, entry in sorted(stats.items(), key=lambda x: -x[1]["seconds"]):
+        print("{:<36} {:8d} calls {:10.3f} s".format(name, entry["count"], entry["seconds"]))
+
+
+class cprofile:
+    # Profiler hook for launch_search(profiler=cprofile): profiles func and
+    # writes profile.prof (pstats format) into the trial's config_dir.
+
+    def __init__(self, config_dir):
+        self.path = os.path.join(config_dir, "profile.prof")
+        self.profile = cProfile.Profile()
+
+    def __enter__(self):
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *args):
+        self.profile.disable()
+        self.profile.create_stats()
+        with fsspec.open(self.path, "wb") as f:
+            f.write(marshal.dumps(self.profile.stats))
+        return False
@@ -0,0 +1,135 @@
+import os
+import time
+import uuid
+import socket
+import hashlib
+import threading
+from .utils import yaml_load, yaml_dump
+from . import rfs
+
+worker_id = "{}-{}-{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+def make_lease(ttl, owner=None):
+    return {"owner": owner or worker_id,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "ttl": ttl,
+            "expires": time.time() + ttl}
+
+def dump_lease(lease):
+    return yaml_dump(lease)
+
+def read_lease(lock_path):
+    # None if there is no lock. Locks written before leases existed
+    # ("Running") have no expiry and never expire.
+    try:
+        lease = yaml_load(rfs.cat(lock_path).decode("utf-8"))
+    except FileNotFoundError:
+        return None
+    if not isinstance(lease, dict):
+        return {"owner": None, "expires": None}
+    return lease
+
+def lease_expired(lease, now=None):
+    if lease is None or lease.get("expires") is None:
+        return False
+    if now is None:
+        now = time.time()
+    return lease["expires"] < now
+
+def owns_lease(lock_path):
+    lease = read_lease(lock_path)
+    return lease is not None and lease.get("owner") == worker_id
+
+def release_lease(lock_path):
+    # Deletes lock_path only while it holds this worker's lease, a lock that
+    # was reclaimed belongs to its new owner. Returns whether it was deleted.
+    if not owns_lease(lock_path):
+        return False
+    try:
+        rfs.rm(lock_path)
+    except FileNotFoundError:
+        pass
+    return True
+
+def reclaim_lease(lock_path, lease, ttl):
+    # Several workers may see the same expired lease. The right to replace it
+    # is a marker named after that lease, created exclusively, so only one
+    # of them takes the trial over. The lock is read again under the marker,
+    # a worker that read it before the takeover (or before a late renewal)
+    # then finds another lease and backs off, so the marker can be removed.
+    token = hashlib.sha1("{}-{}".format(lease.get("owner"), lease.get("expires"))
+                         .encode("utf-8")).hexdigest()[:16]
+    marker_path = "{}.reclaim-{}".format(lock_path, token)
+    if not rfs.create_exclusive(marker_path, worker_id):
+        return False
+    try:
+        current = read_lease(lock_path)
+        if current is None or current.get("owner") != lease.get("owner") \
+                or current.get("expires") != lease.get("expires"):
+            return False
+        rfs.pipe(lock_path, dump_lease(make_lease(ttl)))
+        return True
+    finally:
+        rfs.rm(marker_path)
+
+
+class LeaseKeeper:
+    # Renews the leases held by this worker from a background thread every
+    # ttl / 3 seconds. A lease whose lock.tag now names another owner was
+    # reclaimed by someone else; it is dropped and reported in `lost`, and
+    # the trial's results must not be saved.
+
+    def __init__(self, ttl=600, interval=None):
+        self.ttl = ttl
+        self.interval = interval if interval is not None else ttl / 3
+        self.lost = set()
+        self._lock_paths = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="rena-lease", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def add(self, lock_path):
+        with self._lock:
+            self._lock_paths.add(lock_path)
+
+    def remove(self, lock_path):
+        # Once this returns no renewal of lock_path is in flight, so the lock
+        # can be deleted without being written back.
+        with self._lock:
+            self._lock_paths.discard(lock_path)
+
+    def renew(self):
+        with self._lock:
+            for lock_path in list(self._lock_paths):
+                try:
+                    lease = read_lease(lock_path)
+                    if lease is None or lease.get("owner") != worker_id:
+                        self._lock_paths.discard(lock_path)
+                        self.lost.add(lock_path)
+                        print("Lease lost: {}".format(lock_path))
+                        continue
+                    rfs.pipe(lock_path, dump_lease(make_lease(self.ttl)))
+                except Exception as e:
+                    print("Lease renewal failed: {}: {}".format(lock_path, e))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.renew()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,57 @@
+import os
+import pickle
+import hashlib
+from .utils import load_yaml
+from . import rfs
+
+_cached_files = ["results.pkl", "metrics.yaml", "persistent_dir_link.txt"]
+
+
+class ResultCache:
+    # Content-addressed results of finished trials, shared between sweeps:
+    # <root>/<key>/ holds results.pkl, metrics.yaml and persistent_dir_link.txt
+    # (if any), key = sha256(trial_hash + salt) where trial_hash is the
+    # config_hash of the trial's Config. Change the salt when
+    # the code changes in a way that invalidates old results. complete.tag is
+    # written last, so half-stored entries are never used.
+
+    def __init__(self, root, salt=""):
+        self.root = root
+        self.salt = salt
+
+    def key(self, trial_hash):
+        return hashlib.sha256("{}\n{}".format(trial_hash, self.salt)
+                              .encode("utf-8")).hexdigest()
+
+    def entry_dir(self, trial_hash):
+        return os.path.join(self.root, self.key(trial_hash))
+
+    def contains(self, trial_hash):
+        return rfs.isfile(os.path.join(self.entry_dir(trial_hash), "complete.tag"))
+
+    def restore(self, trial_hash, config_dir):
+        # Copies a stored entry into config_dir and returns its metrics, or
+        # None when there is no entry.
+        entry_dir = self.entry_dir(trial_hash)
+        try:
+            stored_files = set(os.path.basename(p.rstrip("/")) for p in rfs.ls(entry_dir))
+        except FileNotFoundError:
+            return None
+        if "complete.tag" not in stored_files:
+            return None
+        for file_name in _cached_files:
+            if file_name in stored_files:
+                rfs.copy(os.path.join(entry_dir, file_name), os.path.join(config_dir, file_name))
+        return load_yaml(os.path.join(entry_dir, "metrics.yaml"))
+
+    def store(self, trial_hash, config_dir):
+        entry_dir = self.entry_dir(trial_hash)
+        for file_name in _cached_files:
+            src = os.path.join(config_dir, file_name)
+            if file_name == "results.pkl" or rfs.isfile(src):
+                rfs.copy(src, os.path.join(entry_dir, file_name))
+        rfs.pipe(os.path.join(entry_dir, "complete.tag"), os.path.basename(config_dir.rstrip("/")))
+
+    def load_results(self, trial_hash):
+        with rfs.open(os.path.join(self.entry_dir(trial_hash), "results.pkl"), "rb") as f:
+            return pickle.load(f)
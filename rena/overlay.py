@@ -0,0 +1,73 @@
+from copy import deepcopy
+from collections.abc import Mapping
+
+
+class OverlayView(Mapping):
+    # Read-only merge of parsed config layers, the view of `a+b+c-d` that
+    # deep_update and deep_filter would build, without copying anything.
+    # Layers are lowest precedence first. A key resolves to the value of the
+    # highest layer holding it; dicts merge with the dicts right below them
+    # and stop at the first non-dict, which they replaced. mask is the `-`
+    # selector: only its keys are visible, in its order, and a dict in the
+    # mask restricts the subtree under the same key.
+
+    def __init__(self, layers, mask=None):
+        self.layers = layers
+        self.mask = mask
+        self._keys = None
+        self._children = {}
+
+    def keys(self):
+        if self._keys is None:
+            if self.mask is not None:
+                self._keys = list(self.mask.keys())
+            else:
+                keys = {}
+                for layer in self.layers:
+                    keys.update(dict.fromkeys(layer.keys()))
+                self._keys = list(keys.keys())
+        return self._keys
+
+    def __getitem__(self, key):
+        if key in self._children:
+            return self._children[key]
+        if self.mask is not None and key not in self.mask:
+            raise KeyError(key)
+        dicts = []
+        for layer in reversed(self.layers):
+            if key not in layer:
+                continue
+            value = layer[key]
+            if not isinstance(value, dict):
+                if len(dicts) == 0:
+                    return value
+                break
+            dicts.append(value)
+        if len(dicts) == 0:
+            raise KeyError(key)
+        mask = self.mask[key] if self.mask is not None else None
+        child = OverlayView(dicts[::-1], mask if isinstance(mask, dict) else None)
+        self._children[key] = child
+        return child
+
+    def __contains__(self, key):
+        if self.mask is not None:
+            return key in self.mask
+        return any(key in layer for layer in self.layers)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_dict(self):
+        # merged copy, leaves are copied so the layers stay untouched
+        res = {}
+        for k in self.keys():
+            v = self[k]
+            res[k] = v.to_dict() if isinstance(v, OverlayView) else deepcopy(v)
+        return res
+
+    def __repr__(self):
+        return "OverlayView({} layers, keys={})".format(len(self.layers), self.keys())
@@ -0,0 +1,116 @@
+from collections.abc import Mapping
+from .utils import deep_update
+
+
+def _mapping_items(node):
+    for k, v in node.items():
+        yield k, v, isinstance(v, Mapping)
+
+def iter_leaves(tree, items=_mapping_items, prefix=""):
+    # (dotted name, path, value) of every leaf, depth first in one pass.
+    # items(node) yields (key, value, is_node) for the children of a node,
+    # names start with prefix + "." if a prefix is given.
+    stack = [(prefix, (), iter(items(tree)))]
+    while len(stack) > 0:
+        prefix, path, it = stack[-1]
+        for k, v, is_node in it:
+            name = k if prefix == "" else prefix + "." + k
+            if is_node:
+                stack.append((name, path + (k,), iter(items(v))))
+                break
+            yield name, path + (k,), v
+        else:
+            stack.pop()
+
+def flatten_dict(tree, items=_mapping_items, prefix=""):
+    return {name: v for name, _, v in iter_leaves(tree, items, prefix)}
+
+def split_path(name):
+    return tuple(name.split(".")) if isinstance(name, str) else (name,)
+
+def unflatten_dict(flat):
+    # Inverse of flatten_dict in one pass over the keys, with the result of
+    # deep_update-ing the one-key nested dicts of the keys in order: a later
+    # key replaces a leaf on its path, dicts merge. Dicts found in the values
+    # are copied before anything is inserted below them.
+    root = {}
+    owned = {id(root)}
+    for name, v in flat.items():
+        path = split_path(name)
+        node = root
+        for k in path[:-1]:
+            child = node.get(k)
+            if not isinstance(child, dict):
+                child = node[k] = {}
+                owned.add(id(child))
+            elif id(child) not in owned:
+                child = node[k] = dict(child)
+                owned.add(id(child))
+            node = child
+        k = path[-1]
+        if isinstance(node.get(k), dict) and isinstance(v, dict):
+            node[k] = deep_update(node[k], v)
+            owned.add(id(node[k]))
+        else:
+            node[k] = v
+    return root
+
+
+class PathIndex:
+    # Dotted names of the leaves of a tree and their key paths, built once
+    # and shared by every tree of the same structure.
+
+    def __init__(self, names, paths):
+        self.names = names
+        self.paths = dict(zip(names, paths))
+
+    @classmethod
+    def from_tree(cls, tree, items=_mapping_items):
+        names, paths = [], []
+        for name, path, _ in iter_leaves(tree, items):
+            names.append(name)
+            paths.append(path)
+        return cls(names, paths)
+
+    def add(self, name):
+        if name not in self.paths:
+            self.names.append(name)
+            self.paths[name] = split_path(name)
+
+    def __len__(self):
+        return len(self.names)
+
+
+class FlatView(Mapping):
+    # Dotted-name view of a nested config. Reads and writes go through the
+    # nodes' own __getitem__ / __setitem__, so nothing is copied, usage is
+    # counted as for nested access and the two views never diverge. The
+    # index is only valid while the tree keeps its structure.
+
+    def __init__(self, tree, index=None):
+        self.tree = tree
+        self.index = index if index is not None else PathIndex.from_tree(tree)
+
+    def _parent(self, path):
+        node = self.tree
+        for k in path[:-1]:
+            node = node[k]
+        return node
+
+    def __getitem__(self, name):
+        path = self.index.paths[name]
+        return self._parent(path)[path[-1]]
+
+    def __setitem__(self, name, value):
+        path = self.index.paths.get(name) or split_path(name)
+        self._parent(path)[path[-1]] = value
+        self.index.add(name)
+
+    def __contains__(self, name):
+        return name in self.index.paths
+
+    def __iter__(self):
+        return iter(self.index.names)
+
+    def __len__(self):
+        return len(self.index)
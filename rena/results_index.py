@@ -0,0 +1,104 @@
+import os
+import time
+import threading
+from .utils import yaml_load, yaml_dump
+from .lease import worker_id
+from . import rfs
+
+
+def get_results_index_dir(prefix):
+    return os.path.join(prefix, "results_index")
+
+def _record_path(prefix, writer_id, seq):
+    return os.path.join(get_results_index_dir(prefix), writer_id, "{:08d}.yaml".format(seq))
+
+
+class ResultsIndexWriter:
+    # Append-only shard of one worker: results_index/<writer_id>/<seq>.yaml,
+    # one small object per record since object stores cannot append.
+
+    def __init__(self, prefix, writer_id=None):
+        self.prefix = prefix
+        self.writer_id = writer_id or worker_id
+        self.seq = 0
+        self._lock = threading.Lock()
+
+    def append(self, record):
+        # Sequence numbers must stay contiguous, readers stop at the first gap.
+        with self._lock:
+            while not rfs.create_exclusive(_record_path(self.prefix, self.writer_id, self.seq),
+                                           yaml_dump(record)):
+                self.seq += 1
+            self.seq += 1
+
+
+class ResultsIndex:
+    # Reader side. refresh() lists the writers once and then only probes
+    # records past the last one read from each shard. A shard that came up
+    # short last time is probed for one record, its window doubles (up to
+    # `window`) while probes keep hitting, so an idle sweep costs one GET per
+    # writer and a busy one a GET per new record plus one per writer.
+
+    def __init__(self, prefix, window=16):
+        self.prefix = prefix
+        self.window = window
+        self.records = {}
+        self._next_seq = {}
+        self._windows = {}
+
+    def refresh(self, fetch_configs=False):
+        # With fetch_configs, config.yaml is read into record["config"] for
+        # every finished record that does not have it yet.
+        try:
+            writer_ids = [os.path.basename(p.rstrip("/"))
+                          for p in rfs.ls(get_results_index_dir(self.prefix))]
+        except FileNotFoundError:
+            writer_ids = []
+        new_records = []
+        pending = list(writer_ids)
+        while len(pending) > 0:
+            paths = {}
+            for writer_id in pending:
+                seq = self._next_seq.get(writer_id, 0)
+                for i in range(seq, seq + self._windows.get(writer_id, 1)):
+                    paths[_record_path(self.prefix, writer_id, i)] = (writer_id, i)
+            docs = rfs.cat_many(list(paths.keys()))
+            full = set(pending)
+            for path in sorted(paths.keys()):
+                writer_id, seq = paths[path]
+                if writer_id not in full or seq != self._next_seq.get(writer_id, 0):
+                    continue
+                doc = docs[path]
+                if isinstance(doc, Exception):
+                    full.discard(writer_id)
+                    self._windows[writer_id] = 1
+                    continue
+                record = yaml_load(doc.decode("utf-8"))
+                self.records[record["trial"]] = record
+                new_records.append(record)
+                self._next_seq[writer_id] = seq + 1
+            for writer_id in full:
+                self._windows[writer_id] = min(2 * self._windows.get(writer_id, 1), self.window)
+            pending = [w for w in pending if w in full]
+        if fetch_configs:
+            # also records read by an earlier refresh without fetch_configs
+            missing = [r for r in self.records.values()
+                       if r["state"] == "finished" and "config" not in r]
+            paths = [os.path.join(self.prefix, r["trial"], "config.yaml") for r in missing]
+            docs = rfs.cat_many(paths)
+            for record, path in zip(missing, paths):
+                if not isinstance(docs[path], Exception):
+                    record["config"] = yaml_load(docs[path].decode("utf-8"))
+        return new_records
+
+    def config_dirs(self, state="finished"):
+        return [os.path.join(self.prefix, r["trial"])
+                for r in self.records.values() if r["state"] == state]
+
+
+def make_record(config_dir, state, config_hash=None, metrics=None):
+    return {"trial": os.path.basename(config_dir.rstrip("/")),
+            "state": state,
+            "config_hash": config_hash,
+            "metrics": metrics,
+            "time": time.time()}
@@ -1,27 +1,312 @@
+import os
+import time
+import threading
 import fsspec
+import fsspec.asyn
+from fsspec.core import split_protocol
+from concurrent.futures import ThreadPoolExecutor
+from fsspec.implementations.local import LocalFileSystem
+from .instrument import timed, count
 
-def isfile(url, *, fs=None):
-    if fs is not None:
+
+class Session:
+    # Filesystem access for rena. Filesystem instances are created once per
+    # protocol and storage options instead of parsing every url with
+    # url_to_fs. ls/find results are cached for listing_ttl seconds (0, the
+    # default, disables the cache); writes, creates and removes made through
+    # the session drop the cached listings above the written path, writes
+    # by other workers show up once the entries expire.
+
+    def __init__(self, listing_ttl=0.0, storage_options=None):
+        self.listing_ttl = listing_ttl
+        # {protocol: options}, e.g. {"s3": {"anon": False}}
+        self.storage_options = storage_options or {}
+        self._fs = {}
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def get_fs(self, url):
+        # (fs, path) for url, chained urls ("a::b") still go through url_to_fs
+        if "::" in url:
+            return fsspec.core.url_to_fs(url)
+        protocol = split_protocol(url)[0] or "file"
+        fs = self._fs.get(protocol)
+        if fs is None:
+            fs = fsspec.filesystem(protocol, **self.storage_options.get(protocol, {}))
+            with self._lock:
+                fs = self._fs.setdefault(protocol, fs)
+        return fs, fs._strip_protocol(url)
+
+    def _resolve(self, url, fs):
+        if fs is None:
+            return self.get_fs(url)
+        return fs, fs._strip_protocol(url)
+
+    def _cached_listing(self, kind, fs, path, list_fn):
+        if self.listing_ttl <= 0:
+            return list_fn()
+        key = (kind, id(fs), path)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._listings.get(key)
+        if entry is not None and entry[0] > now:
+            count("rfs.listing_cache.hits")
+            return list(entry[1])
+        res = list_fn()
+        with self._lock:
+            self._listings[key] = (now + self.listing_ttl, res)
+        return list(res)
+
+    def invalidate(self, fs, path):
+        # Drops cached listings of path and of every directory above it.
+        if len(self._listings) == 0:
+            return
+        with self._lock:
+            for key in list(self._listings.keys()):
+                listed = key[2].rstrip("/")
+                if path == listed or path.startswith(listed + "/") \
+                        or listed.startswith(path.rstrip("/") + "/"):
+                    del self._listings[key]
+
+    def invalidate_all(self):
+        with self._lock:
+            self._listings.clear()
+
+    @timed("rfs.isfile")
+    def isfile(self, url, *, fs=None):
+        fs, url_path = self._resolve(url, fs)
         return fs.isfile(url_path)
-    fs, url_path = fsspec.core.url_to_fs(url)
-    return fs.isfile(url_path)
+
+    @timed("rfs.isfile_many")
+    def isfile_many(self, urls, max_workers=32):
+        # [bool] for urls. Paths sharing a directory are answered from one
+        # listing of it, the rest are checked concurrently (one batched
+        # gather on async backends).
+        res = {}
+        groups = {}
+        for url in urls:
+            fs, path = self.get_fs(url)
+            groups.setdefault((id(fs), fs._parent(path)), (fs, []))[1].append((url, path))
+        singles = []
+        for (_, parent), (fs, members) in groups.items():
+            if len(members) < 2:
+                singles.extend((fs, url, path) for url, path in members)
+                continue
+            try:
+                files = set(info["name"].rstrip("/") for info in
+                            self._cached_listing("ls_detail", fs, parent,
+                                                 lambda: fs.ls(parent, detail=True))
+                            if info["type"] == "file")
+            except FileNotFoundError:
+                files = set()
+            for url, path in members:
+                res[url] = path.rstrip("/") in files
+        if len(singles) > 0:
+            count("rfs.isfile_many.singles", len(singles))
+            fs = singles[0][0]
+            if fs.async_impl and all(f is fs for f, _, _ in singles):
+                found = fsspec.asyn.sync(fs.loop, fsspec.asyn._run_coros_in_chunks,
+                                         [fs._isfile(path) for _, _, path in singles],
+                                         batch_size=max_workers, return_exceptions=True)
+            else:
+                with ThreadPoolExecutor(max_workers) as pool:
+                    found = list(pool.map(lambda x: x[0].isfile(x[2]), singles))
+            for (_, url, _), ok in zip(singles, found):
+                if isinstance(ok, Exception):
+                    raise ok
+                res[url] = ok
+        return [res[url] for url in urls]
+
+    @timed("rfs.ls")
+    def ls(self, url, *, fs=None):
+        fs, url_path = self._resolve(url, fs)
+        res = self._cached_listing("ls", fs, url_path,
+                                   lambda: fs.ls(url_path, detail=False))
+        if url.startswith("s3://"):
+            res = ["s3://" + r for r in res]
+        return res
+
+    @timed("rfs.find")
+    def find(self, url, *, fs=None):
+        # All files below url, as paths relative to url, from one recursive
+        # listing (a single paginated LIST on object stores).
+        fs, url_path = self._resolve(url, fs)
+        root = url_path.rstrip("/") + "/"
+        paths = self._cached_listing("find", fs, url_path, lambda: fs.find(url_path))
+        return [p[len(root):] for p in paths if p.startswith(root)]
+
+    @timed("rfs.rm")
+    def rm(self, url, recursive=False, *, fs=None):
+        fs, url_path = self._resolve(url, fs)
+        try:
+            fs.rm(url_path, recursive=recursive)
+        finally:
+            self.invalidate(fs, url_path)
+
+    @timed("rfs.rm_many")
+    def rm_many(self, urls, missing_ok=True):
+        # One bulk delete per filesystem (s3 deletes up to 1000 keys per
+        # request), missing files are skipped with missing_ok.
+        groups = {}
+        for url in urls:
+            fs, path = self.get_fs(url)
+            groups.setdefault(id(fs), (fs, []))[1].append(path)
+        for fs, paths in groups.values():
+            try:
+                fs.rm(paths)
+            except FileNotFoundError:
+                if not missing_ok:
+                    raise
+                for path in paths:
+                    try:
+                        fs.rm(path)
+                    except FileNotFoundError:
+                        pass
+            finally:
+                for path in paths:
+                    self.invalidate(fs, path)
+
+    @timed("rfs.put")
+    def put(self, local_path, remote_path, recursive=True):
+        fs, url_path = self.get_fs(remote_path)
+        fs.put(local_path, url_path, recursive=recursive)
+        self.invalidate(fs, url_path)
+
+    def open(self, url, mode="rb", **kwargs):
+        # fs.open, creating local parent directories for writes like
+        # fsspec.open does
+        fs, url_path = self.get_fs(url)
+        if "r" not in mode:
+            count("rfs.open.write")
+            if isinstance(fs, LocalFileSystem):
+                fs.makedirs(fs._parent(url_path), exist_ok=True)
+            self.invalidate(fs, url_path)
+        else:
+            count("rfs.open.read")
+        return fs.open(url_path, mode, **kwargs)
+
+    @timed("rfs.cat")
+    def cat(self, url):
+        fs, url_path = self.get_fs(url)
+        return fs.cat_file(url_path)
+
+    @timed("rfs.pipe")
+    def pipe(self, url, data):
+        fs, url_path = self.get_fs(url)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if isinstance(fs, LocalFileSystem):
+            fs.makedirs(fs._parent(url_path), exist_ok=True)
+        fs.pipe_file(url_path, data)
+        self.invalidate(fs, url_path)
+
+    @timed("rfs.create_exclusive")
+    def create_exclusive(self, url, data, *, fs=None):
+        # Writes data to url only if url does not exist yet, returns whether it
+        # was created. Backends without exclusive create ("xb") fall back to a
+        # non-atomic exists check.
+        fs, url_path = self._resolve(url, fs)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if isinstance(fs, LocalFileSystem):
+            fs.makedirs(fs._parent(url_path), exist_ok=True)
+        try:
+            with fs.open(url_path, "xb") as f:
+                f.write(data)
+        except FileExistsError:
+            return False
+        except (NotImplementedError, ValueError):
+            if fs.exists(url_path):
+                return False
+            fs.pipe_file(url_path, data)
+        self.invalidate(fs, url_path)
+        return True
+
+    @timed("rfs.cat_many")
+    def cat_many(self, urls, max_workers=32):
+        # {url: bytes or the exception raised for it}. Async backends (s3, gcs,
+        # http) fetch in one batched call, others from a thread pool.
+        if len(urls) == 0:
+            return {}
+        count("rfs.cat_many.urls", len(urls))
+        fs, _ = self.get_fs(urls[0])
+        paths = [fs._strip_protocol(url) for url in urls]
+        if fs.async_impl:
+            res = fs.cat(paths, on_error="return", batch_size=max_workers)
+            return {url: res[path] for url, path in zip(urls, paths)}
+
+        def cat_one(path):
+            try:
+                return fs.cat_file(path)
+            except Exception as e:
+                return e
+        with ThreadPoolExecutor(max_workers) as pool:
+            return dict(zip(urls, pool.map(cat_one, paths)))
+
+    @timed("rfs.copy")
+    def copy(self, src_url, dst_url):
+        # Server-side copy within one filesystem, read and write otherwise.
+        src_fs, src_path = self.get_fs(src_url)
+        dst_fs, dst_path = self.get_fs(dst_url)
+        if isinstance(dst_fs, LocalFileSystem):
+            dst_fs.makedirs(dst_fs._parent(dst_path), exist_ok=True)
+        if src_fs is dst_fs:
+            src_fs.copy(src_path, dst_path)
+        else:
+            dst_fs.pipe_file(dst_path, src_fs.cat_file(src_path))
+        self.invalidate(dst_fs, dst_path)
+
+
+_session = Session(listing_ttl=float(os.environ.get("RENA_LISTING_TTL", "0")))
+
+def get_session():
+    return _session
+
+def set_session(session):
+    global _session
+    _session = session
+
+
+# Module-level functions use the current session.
+
+def get_fs(url):
+    return _session.get_fs(url)
+
+def isfile(url, *, fs=None):
+    return _session.isfile(url, fs=fs)
+
+def isfile_many(urls, max_workers=32):
+    return _session.isfile_many(urls, max_workers=max_workers)
+
 def ls(url, *, fs=None):
-    if fs is not None:
-        res = fs.ls(url_path, detail=False)
-    else:
-        fs, url_path = fsspec.core.url_to_fs(url)
-        res = fs.ls(url_path, detail=False)
-    if url.startswith("s3://"):
-        res = ["s3://" + r for r in res]
-    return res
-    
+    return _session.ls(url, fs=fs)
+
+def find(url, *, fs=None):
+    return _session.find(url, fs=fs)
+
 def rm(url, recursive=False, *, fs=None):
-    if fs is not None:
-        fs.rm(url_path, recursive=recursive)
-    else:
-        fs, url_path = fsspec.core.url_to_fs(url)
-        fs.rm(url_path, recursive=recursive)
-        
+    _session.rm(url, recursive=recursive, fs=fs)
+
+def rm_many(urls, missing_ok=True):
+    _session.rm_many(urls, missing_ok=missing_ok)
+
 def put(local_path, remote_path, recursive=True):
-    fs = fsspec.core.url_to_fs(remote_path)
-    fs.put(local_path, remote_path, recursive=recursive)
\ No newline at end of file
+    _session.put(local_path, remote_path, recursive=recursive)
+
+def open(url, mode="rb", **kwargs):
+    return _session.open(url, mode, **kwargs)
+
+def cat(url):
+    return _session.cat(url)
+
+def pipe(url, data):
+    _session.pipe(url, data)
+
+def create_exclusive(url, data, *, fs=None):
+    return _session.create_exclusive(url, data, fs=fs)
+
+def cat_many(urls, max_workers=32):
+    return _session.cat_many(urls, max_workers=max_workers)
+
+def copy(src_url, dst_url):
+    _session.copy(src_url, dst_url)
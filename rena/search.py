@@ -0,0 +1,129 @@
+import numpy as np
+
+_index_limit = 2 ** 62
+_enumerate_limit = 2 ** 24
+
+
+def _unique_values(values):
+    # Search lists may repeat a value, e.g. [1, 2, 3, 2], and may hold
+    # unhashable values, so duplicates are removed with ==.
+    res = []
+    for v in values:
+        if not any(v == u and type(v) == type(u) for u in res):
+            res.append(v)
+    return res
+
+
+class SearchSpace:
+    # Mixed-radix view of a flattened search config ({"a.b": [v0, v1, ...]}).
+    # Point i has digit d_k = (i // prod(radices[k+1:])) % radices[k] for the
+    # k-th key, so every point of the space is one integer in [0, size).
+
+    def __init__(self, flat_search_dict):
+        self.keys = list(flat_search_dict.keys())
+        self.choices = []
+        for k in self.keys:
+            assert isinstance(flat_search_dict[k], list) and len(flat_search_dict[k]) > 0, k
+            self.choices.append(_unique_values(flat_search_dict[k]))
+        self.radices = [len(c) for c in self.choices]
+        self.size = 1
+        for r in self.radices:
+            self.size *= r
+        self._strides = []
+        stride = 1
+        for r in reversed(self.radices):
+            self._strides.append(stride)
+            stride *= r
+        self._strides.reverse()
+
+    def __len__(self):
+        return self.size
+
+    def digits(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        radices = np.asarray(self.radices, dtype=np.int64)
+        strides = np.asarray(self._strides, dtype=np.int64)
+        return (indices[:, None] // strides[None, :]) % radices[None, :]
+
+    def index_of_digits(self, digits):
+        digits = np.asarray(digits, dtype=np.int64)
+        return digits @ np.asarray(self._strides, dtype=np.int64)
+
+    def point(self, index):
+        res = {}
+        for k, choices, radix, stride in zip(self.keys, self.choices,
+                                             self.radices, self._strides):
+            res[k] = choices[(index // stride) % radix]
+        return res
+
+    def index(self, point):
+        # Returns None when a value is not one of the choices.
+        index = 0
+        for k, choices, stride in zip(self.keys, self.choices, self._strides):
+            for d, v in enumerate(choices):
+                if v == point[k] and type(v) == type(point[k]):
+                    break
+            else:
+                return None
+            index += d * stride
+        return index
+
+    def coverage(self, num_points):
+        return num_points / self.size
+
+    def _quasi_engine(self, mode, rng):
+        d = len(self.keys)
+        if mode == "sobol":
+            try:
+                from scipy.stats import qmc
+            except ImportError:
+                raise ImportError("mode 'sobol' requires scipy")
+            engine = qmc.Sobol(d, scramble=True, seed=rng)
+            return engine.random
+        elif mode == "lhs":
+            def lhs(n):
+                u = (rng.random((n, d)) + np.arange(n)[:, None]) / n
+                for j in range(d):
+                    u[:, j] = u[rng.permutation(n), j]
+                return u
+            return lhs
+        raise ValueError("Unknown mode: {}".format(mode))
+
+    def _draw(self, n, engine, rng):
+        radices = np.asarray(self.radices, dtype=np.int64)
+        if engine is None:
+            if self.size <= _index_limit:
+                return rng.integers(0, self.size, size=n)
+            digits = np.stack([rng.integers(0, r, size=n) for r in self.radices], axis=1)
+        else:
+            digits = np.minimum((engine(n) * radices).astype(np.int64), radices - 1)
+        if self.size <= _index_limit:
+            return self.index_of_digits(digits)
+        return [sum(int(x) * s for x, s in zip(row, self._strides)) for row in digits]
+
+    def sample(self, mode="random", batch_size=256, seed=None, exclude=()):
+        # Yields distinct indices not in exclude, drawn in vectorized batches.
+        # "grid" walks the space in order, "random" draws uniformly and
+        # "sobol"/"lhs" draw quasi-random batches. Once most of the space is
+        # used up the remaining points are enumerated instead of rejected.
+        if mode == "grid":
+            for i in range(self.size):
+                if i not in exclude:
+                    yield i
+            return
+        rng = np.random.default_rng(seed)
+        engine = None if mode == "random" else self._quasi_engine(mode, rng)
+        seen = set(exclude)
+        while len(seen) < self.size:
+            remaining = self.size - len(seen)
+            if self.size <= _enumerate_limit and remaining * 4 <= self.size:
+                rest = np.setdiff1d(np.arange(self.size),
+                                    np.fromiter(seen, dtype=np.int64, count=len(seen)))
+                for i in rng.permutation(rest):
+                    yield int(i)
+                return
+            for i in self._draw(batch_size, engine, rng):
+                i = int(i)
+                if i not in seen:
+                    seen.add(i)
+                    yield i
@@ -0,0 +1,123 @@
+import os
+import pickle
+import numpy as np
+from .paths import flatten_dict
+from .utils import yaml_load
+from . import rfs
+
+
+def _flatten(d, prefix):
+    return {prefix + "." + k: v for k, v in flatten_dict(d).items()}
+
+def _column(values):
+    if all(v is None or (isinstance(v, (int, float, np.number)) and not isinstance(v, bool))
+           for v in values):
+        return np.array([np.nan if v is None else v for v in values], dtype=float)
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+class ResultTable:
+    # Column store of finished trials: "config_dir", then "config.<key>" and
+    # "metrics.<key>" for every flattened key. Numeric columns are float
+    # arrays with nan for missing values, others are object arrays.
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    @classmethod
+    def from_records(cls, records):
+        keys = []
+        seen = set()
+        for record in records:
+            for k in record.keys():
+                if k not in seen:
+                    seen.add(k)
+                    keys.append(k)
+        return cls({k: _column([record.get(k) for record in records]) for k in keys})
+
+    def __len__(self):
+        if len(self.columns) == 0:
+            return 0
+        return len(next(iter(self.columns.values())))
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def keys(self):
+        return list(self.columns.keys())
+
+    def take(self, indices):
+        return ResultTable({k: v[indices] for k, v in self.columns.items()})
+
+    def filter(self, mask):
+        return self.take(np.nonzero(np.asarray(mask))[0])
+
+    def sort(self, by, descending=False):
+        column = self.columns[by]
+        if column.dtype == object:
+            order = sorted(range(len(column)), key=lambda i: str(column[i]),
+                           reverse=descending)
+        else:
+            # nan last in both directions
+            order = np.argsort(-column if descending else column, kind="stable")
+        return self.take(np.asarray(order, dtype=np.int64))
+
+    def top_k(self, by, k, largest=True):
+        column = self.columns[by].astype(float)
+        keys = np.where(np.isnan(column), np.inf, -column if largest else column)
+        k = min(k, len(column))
+        if k == 0:
+            return self.take(np.arange(0))
+        index = np.argpartition(keys, k - 1)[:k]
+        index = index[np.argsort(keys[index], kind="stable")]
+        return self.take(index)
+
+    def rows(self):
+        return [{k: v[i] for k, v in self.columns.items()} for i in range(len(self))]
+
+    def load_results(self, i):
+        # results.pkl of the i-th row, only read when asked for
+        with rfs.open(os.path.join(self.columns["config_dir"][i], "results.pkl"), "rb") as f:
+            return pickle.load(f)
+
+    def __repr__(self):
+        return "ResultTable({} rows: {})".format(len(self), ", ".join(self.keys()))
+
+
+def result_record(config_dir, config, metrics):
+    record = {"config_dir": config_dir}
+    record.update(_flatten(config or {}, "config"))
+    record.update(_flatten(metrics or {}, "metrics"))
+    return record
+
+def load_result_table(config_dirs, max_workers=32):
+    config_dirs = list(config_dirs)
+    paths = []
+    for config_dir in config_dirs:
+        paths.append(os.path.join(config_dir, "metrics.yaml"))
+        paths.append(os.path.join(config_dir, "config.yaml"))
+    docs = rfs.cat_many(paths, max_workers=max_workers)
+    records = []
+    for config_dir in config_dirs:
+        loaded = {}
+        for name in ["config", "metrics"]:
+            doc = docs[os.path.join(config_dir, name + ".yaml")]
+            if isinstance(doc, Exception):
+                print("Skip {}: {!r}".format(config_dir, doc))
+                break
+            loaded[name] = yaml_load(doc.decode("utf-8"))
+        else:
+            records.append(result_record(config_dir, loaded["config"], loaded["metrics"]))
+    return ResultTable.from_records(records)
+
+def load_indexed_result_table(index):
+    # Table from a ResultsIndex, reading only what changed since the last call.
+    index.refresh(fetch_configs=True)
+    records = []
+    for record in index.records.values():
+        if record["state"] == "finished":
+            records.append(result_record(os.path.join(index.prefix, record["trial"]),
+                                         record.get("config"), record["metrics"]))
+    return ResultTable.from_records(records)
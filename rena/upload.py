@@ -0,0 +1,131 @@
+import os
+import time
+import shutil
+import tarfile
+import threading
+from fsspec.implementations.local import LocalFileSystem
+from concurrent.futures import ThreadPoolExecutor, wait
+from . import rfs
+
+SMALL_FILES_TAR = "_small_files.tar"
+
+
+class UploadQueue:
+    # Bounded background queue for trial uploads. submit() blocks once
+    # max_pending jobs are queued or running, failed jobs are retried with
+    # exponential backoff, and close() waits for everything still queued.
+
+    def __init__(self, max_workers=4, max_pending=8, retries=3, backoff=1.0):
+        self.retries = retries
+        self.backoff = backoff
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="rena-upload")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(self._run, fn, args, kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+        self._slots.release()
+        if future.exception() is not None:
+            print("Upload failed: {!r}".format(future.exception()))
+
+    def _run(self, fn, args, kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                print("Upload attempt {} failed ({!r}), retrying in {:.1f}s".format(
+                    attempt + 1, e, delay))
+                time.sleep(delay)
+
+    def flush(self):
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+
+    def close(self):
+        self.flush()
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _local_files(local_dir):
+    res = []
+    for root, _, file_names in os.walk(local_dir):
+        for file_name in file_names:
+            local_path = os.path.join(root, file_name)
+            rel_path = os.path.relpath(local_path, local_dir).replace(os.sep, "/")
+            res.append((rel_path, local_path, os.path.getsize(local_path)))
+    return res
+
+def upload_dir(local_dir, remote_url, max_workers=8, pack_small_files=False,
+               small_file_size=1 << 20, part_size=64 << 20):
+    # Uploads the files of local_dir concurrently. Files of at least
+    # part_size bytes are streamed through fs.open with block_size=part_size,
+    # which object stores turn into multipart uploads. With pack_small_files
+    # files under small_file_size go into one streamed SMALL_FILES_TAR.
+    fs, remote_path = rfs.get_fs(remote_url)
+    remote_path = remote_path.rstrip("/")
+    files = _local_files(local_dir)
+    small_files = []
+    if pack_small_files:
+        small_files = [f for f in files if f[2] < small_file_size]
+        files = [f for f in files if f[2] >= small_file_size]
+    if isinstance(fs, LocalFileSystem):
+        for parent in set(fs._parent(remote_path + "/" + f[0]) for f in files):
+            fs.makedirs(parent, exist_ok=True)
+        fs.makedirs(remote_path, exist_ok=True)
+
+    def upload_file(rel_path, local_path, size):
+        dest = remote_path + "/" + rel_path
+        if size >= part_size:
+            with open(local_path, "rb") as src, \
+                    fs.open(dest, "wb", block_size=part_size) as dst:
+                shutil.copyfileobj(src, dst, part_size)
+        else:
+            fs.put_file(local_path, dest)
+
+    def upload_tar():
+        dest = remote_path + "/" + SMALL_FILES_TAR
+        with fs.open(dest, "wb", block_size=part_size) as dst:
+            with tarfile.open(fileobj=dst, mode="w|") as tar:
+                for rel_path, local_path, _ in small_files:
+                    tar.add(local_path, arcname=rel_path)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers, thread_name_prefix="rena-put") as pool:
+        futures = [pool.submit(upload_file, *f) for f in files]
+        if len(small_files) > 0:
+            futures.append(pool.submit(upload_tar))
+        for future in futures:
+            future.result()
+    seconds = time.time() - start
+    num_bytes = sum(f[2] for f in files) + sum(f[2] for f in small_files)
+    stats = {"files": len(files) + len(small_files),
+             "bytes": num_bytes,
+             "seconds": seconds,
+             "bytes_per_s": num_bytes / seconds if seconds > 0 else float("inf")}
+    print("Uploaded {} files ({:.1f} MB) to {} in {:.2f}s, {:.1f} MB/s".format(
+        stats["files"], num_bytes / 1e6, remote_url, seconds, stats["bytes_per_s"] / 1e6))
+    return stats
@@ -0,0 +1,58 @@
+import sys
+import random
+import linecache
+import threading
+
+# Call sites are interned process-wide: a frame becomes an integer site id and
+# a call stack becomes a tuple of site ids, itself interned to a stack id.
+# Per-key "hist" usage state only keeps {stack_id: count}; code context is read
+# from linecache when the history is resolved.
+_site_ids = {}
+_sites = []
+_stack_ids = {}
+_stacks = []
+_intern_lock = threading.Lock()
+# sampling draws must not advance the user's (seeded) global random state
+_rng = random.Random()
+
+
+def _intern(table, items, key):
+    i = table.get(key)
+    if i is None:
+        with _intern_lock:
+            i = table.get(key)
+            if i is None:
+                i = len(items)
+                items.append(key)
+                table[key] = i
+    return i
+
+
+def record_call_site(hist, depth=1, sample_rate=1.0):
+    if sample_rate < 1.0 and _rng.random() >= sample_rate:
+        return
+    f = sys._getframe(depth + 1)
+    stack = []
+    while f is not None:
+        code = f.f_code
+        stack.append(_intern(_site_ids, _sites,
+                             (code.co_filename, f.f_lineno, code.co_name)))
+        f = f.f_back
+    stack_id = _intern(_stack_ids, _stacks, tuple(stack))
+    hist[stack_id] = hist.get(stack_id, 0) + 1
+
+
+def resolve_site(site_id):
+    filename, lineno, name = _sites[site_id]
+    code = linecache.getline(filename, lineno)
+    return (f"filename: {filename}, line: {lineno}, function: {name}, "
+            f"code: {[code] if code else None}")
+
+
+def resolve_hist(hist):
+    res = []
+    for stack_id, count in hist.items():
+        res.append({"count": count,
+                    "stack": [resolve_site(s) for s in _stacks[stack_id]]})
+    return res
+
@@ -1,7 +1,12 @@
-import yaml
+import os
 import re
-import fsspec
+import yaml
+import time
 import paramiko
+import threading
+from datetime import datetime, timedelta, timezone
+from . import dist, rfs
+from .instrument import timed
 
 def get_ssh_client(hostname, username):
     ssh = paramiko.SSHClient()
@@ -17,9 +22,83 @@ def get_central_dt(hostname, username):
     ssh.close()
     return dt
 
-def get_dt_for_file_name():
-    dt = get_central_dt("114.212.23.229", "yangjq")
-    return dt.replace(":", "_")
+
+class CentralClock:
+    # Clock of a central host: the offset is measured over one kept-alive SSH
+    # connection at most once per `ttl` seconds and extrapolated with the
+    # local monotonic clock in between. With source="local", or when the
+    # host cannot be reached, the local clock is used.
+
+    def __init__(self, hostname, username, ttl=3600, source="ssh"):
+        assert source in ["ssh", "local"]
+        self.hostname = hostname
+        self.username = username
+        self.ttl = ttl
+        self.source = source
+        self._ssh = None
+        self._base = None
+        self._tz = None
+        self._lock = threading.Lock()
+
+    def _measure(self):
+        if self._ssh is None or not self._ssh.get_transport() \
+                or not self._ssh.get_transport().is_active():
+            self._ssh = get_ssh_client(self.hostname, self.username)
+        start = time.monotonic()
+        stdin, stdout, stderr = self._ssh.exec_command("date '+%s.%N %z'")
+        seconds, tz = stdout.readlines()[0].split()
+        end = time.monotonic()
+        tz_minutes = int(tz[0] + "1") * (int(tz[1:3]) * 60 + int(tz[3:5]))
+        return float(seconds), (start + end) / 2, timezone(timedelta(minutes=tz_minutes))
+
+    def _refresh(self):
+        if self.source == "ssh":
+            try:
+                self._base = self._measure()
+                return
+            except Exception as e:
+                print("Central clock unavailable ({!r}), using local clock".format(e))
+                self.close()
+                if self._base is not None:
+                    # keep extrapolating the last measurement, retry later
+                    self._base = (self._base[0] + time.monotonic() - self._base[1],
+                                  time.monotonic(), self._base[2])
+                    return
+        self._base = (time.time(), time.monotonic(), None)
+
+    def now(self):
+        with self._lock:
+            if self._base is None or time.monotonic() - self._base[1] > self.ttl:
+                self._refresh()
+            seconds, mono, tz = self._base
+            return seconds + time.monotonic() - mono, tz
+
+    def close(self):
+        if self._ssh is not None:
+            self._ssh.close()
+            self._ssh = None
+
+
+_central_clock = CentralClock(
+    hostname=os.environ.get("RENA_TIME_HOST", "114.212.23.229"),
+    username=os.environ.get("RENA_TIME_USER", "yangjq"),
+    ttl=float(os.environ.get("RENA_TIME_TTL", 3600)),
+    source=os.environ.get("RENA_TIME_SOURCE", "ssh"))
+_last_usec = 0
+_last_usec_lock = threading.Lock()
+
+def get_dt_for_file_name(clock=None):
+    # e.g. 2022/05/01_12_30_05_000123_r0_p4242. The microseconds are
+    # strictly increasing within a process and rank/pid keep names from
+    # different workers apart.
+    global _last_usec
+    seconds, tz = (clock or _central_clock).now()
+    with _last_usec_lock:
+        usec = max(int(seconds * 1e6), _last_usec + 1)
+        _last_usec = usec
+    dt = datetime.fromtimestamp(usec // 1000000, tz)
+    return "{}_{:06d}_r{}_p{}".format(dt.strftime("%Y/%m/%d_%H_%M_%S"), usec % 1000000,
+                                      dist.local_rank, os.getpid())
 
 def deep_update(mapping, *updating_mappings):
     updated_mapping = mapping.copy()
@@ -42,26 +121,77 @@ def deep_filter(mapping, selector):
     return new_mapping
 
 
-loader = yaml.SafeLoader
-loader.add_implicit_resolver(
-    u'tag:yaml.org,2002:float',
-    re.compile(u'''^(?:
+_float_regexp = re.compile(u'''^(?:
      [-+]?(?:[0-9][0-9_]*)\\.[0-9_]*(?:[eE][-+]?[0-9]+)?
     |[-+]?(?:[0-9][0-9_]*)(?:[eE][-+]?[0-9]+)
     |\\.[0-9_]+(?:[eE][-+][0-9]+)?
     |[-+]?[0-9][0-9_]*(?::[0-5]?[0-9])+\\.[0-9_]*
     |[-+]?\\.(?:inf|Inf|INF)
-    |\\.(?:nan|NaN|NAN))$''', re.X),
-    list(u'-+0123456789.'))
+    |\\.(?:nan|NaN|NAN))$''', re.X)
+
+
+class PyLoader(yaml.SafeLoader):
+    pass
+
+class PyDumper(yaml.Dumper):
+    pass
+
+# Dumpers get the rule too, so strings such as '1e-4' are quoted on dump and
+# survive a round trip.
+for _cls in [PyLoader, PyDumper]:
+    _cls.add_implicit_resolver(
+        u'tag:yaml.org,2002:float', _float_regexp, list(u'-+0123456789.'))
+
+if yaml.__with_libyaml__:
+    # LibYAML only replaces the scanner/parser/emitter, implicit tags are
+    # still resolved by yaml.resolver.Resolver, so the float rule is shared.
+    class CLoader(yaml.CSafeLoader):
+        pass
+
+    class CDumper(yaml.CDumper):
+        pass
+
+    for _cls in [CLoader, CDumper]:
+        _cls.add_implicit_resolver(
+            u'tag:yaml.org,2002:float', _float_regexp, list(u'-+0123456789.'))
+else:
+    CLoader = None
+    CDumper = None
+
+_yaml_backends = {
+    "python": (PyLoader, PyDumper),
+    "c": (CLoader, CDumper),
+}
+
+
+def set_yaml_backend(backend="auto"):
+    global loader, dumper, yaml_backend
+    if backend == "auto":
+        backend = "c" if CLoader is not None else "python"
+    if backend not in _yaml_backends:
+        raise ValueError("Unknown yaml backend: {}".format(backend))
+    if _yaml_backends[backend][0] is None:
+        raise ImportError("yaml backend '{}' requires LibYAML".format(backend))
+    loader, dumper = _yaml_backends[backend]
+    yaml_backend = backend
+    return backend
+
+set_yaml_backend(os.environ.get("RENA_YAML_BACKEND", "auto"))
+
+@timed("yaml.load")
+def yaml_load(stream):
+    return yaml.load(stream, Loader=loader)
+
+@timed("yaml.dump")
+def yaml_dump(obj, stream=None):
+    return yaml.dump(obj, stream, Dumper=dumper, default_flow_style=False)
 
+@timed("yaml.load_file")
 def load_yaml(file_path):
-    with fsspec.open(file_path, "r") as f:
-        return yaml.load(f, Loader=loader)
+    with rfs.open(file_path, "r") as f:
+        return yaml_load(f)
     
+@timed("yaml.save_file")
 def save_yaml(obj, file_path):
-    with fsspec.open(file_path, "w") as f:
-        yaml.dump(
-            obj,
-            f,
-            default_flow_style=False)
-    
\ No newline at end of file
+    with rfs.open(file_path, "w") as f:
+        yaml_dump(obj, f)
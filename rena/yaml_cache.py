@@ -0,0 +1,106 @@
+import os
+import pickle
+import hashlib
+import threading
+from copy import deepcopy
+from collections import OrderedDict
+from .utils import load_yaml
+from . import rfs
+
+_token_keys = ("ETag", "etag", "mtime", "LastModified", "created", "size")
+
+
+def _validation_token(info):
+    return tuple(str(info.get(k)) for k in _token_keys)
+
+
+class YamlCache:
+    # LRU cache of parsed YAML documents keyed by the fsspec path of the file.
+    # An entry is reused only while the file's ETag/mtime/size are unchanged.
+    # With cache_dir set, parsed documents are also pickled to disk so that
+    # fresh processes skip parsing files they have never seen.
+
+    def __init__(self, maxsize=256, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, file_path, copy=True):
+        fs, path = rfs.get_fs(file_path)
+        key = fs.unstrip_protocol(path)
+        token = _validation_token(fs.info(path))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == token:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                doc = entry[1]
+            else:
+                doc = None
+                self.misses += 1
+        if doc is None:
+            doc = self._load_disk(key, token)
+            if doc is None:
+                doc = load_yaml(file_path)
+                self._save_disk(key, token, doc)
+            with self._lock:
+                self._entries[key] = (token, doc)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        if copy:
+            return deepcopy(doc)
+        return doc
+
+    def invalidate(self, file_path):
+        fs, path = rfs.get_fs(file_path)
+        with self._lock:
+            self._entries.pop(fs.unstrip_protocol(path), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _disk_path(self, key, token):
+        digest = hashlib.sha1(repr((key, token)).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest + ".pkl")
+
+    def _load_disk(self, key, token):
+        if self.cache_dir is None:
+            return None
+        disk_path = self._disk_path(key, token)
+        try:
+            with open(disk_path, "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def _save_disk(self, key, token, doc):
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        disk_path = self._disk_path(key, token)
+        tmp_path = "{}.{}.tmp".format(disk_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            pickle.dump(doc, f)
+        os.replace(tmp_path, disk_path)
+
+
+_yaml_cache = YamlCache(
+    maxsize=int(os.environ.get("RENA_YAML_CACHE_SIZE", 256)),
+    cache_dir=os.environ.get("RENA_YAML_CACHE_DIR"))
+
+
+def get_yaml_cache():
+    return _yaml_cache
+
+def set_yaml_cache(maxsize=256, cache_dir=None):
+    global _yaml_cache
+    _yaml_cache = YamlCache(maxsize=maxsize, cache_dir=cache_dir)
+    return _yaml_cache
+
+def load_yaml_cached(file_path, copy=True):
+    return _yaml_cache.load(file_path, copy=copy)
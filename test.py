@@ -1,4 +1,5 @@
 import pprint
+import yaml
 import fsspec
 import numpy as np
 from rena.config import *
@@ -49,6 +50,56 @@ def gen_config():
                                   check_duplicate=True,
                                   num=10)
 
+def test_yaml_backend_parity():
+    from rena import utils
+    if utils.CLoader is None:
+        print("LibYAML not available, skipped")
+        return
+    text = "\n".join([
+        "lr: 1e-4", "wd: 5E+3", "a: 1.", "b: .5", "c: -1_000.5", "d: 1e4",
+        "e: .inf", "f: 10", "g: 1:20.5", "h: 1e-", "i: v1e4", "j: null",
+        "k: [1e-3, 2, x]", "l: {m: 3e2, n: 2022-01-01}", "o: '1e-4'",
+    ])
+    py_obj = yaml.load(text, Loader=utils.PyLoader)
+    c_obj = yaml.load(text, Loader=utils.CLoader)
+    assert repr(py_obj) == repr(c_obj), (py_obj, c_obj)
+    assert isinstance(c_obj["lr"], float) and isinstance(c_obj["o"], str)
+    for obj in [py_obj, config_to_dict(load_config("configs/test+t-std.yaml"))]:
+        py_text = yaml.dump(obj, Dumper=utils.PyDumper, default_flow_style=False)
+        c_text = yaml.dump(obj, Dumper=utils.CDumper, default_flow_style=False)
+        assert py_text == c_text, (py_text, c_text)
+        assert yaml.load(c_text, Loader=utils.CLoader) == obj
+    print("yaml backends agree")
+
+def test_copy_on_write():
+    config = Config({"model": {"lr": 1, "opt": {"m": 0.9}}, "layers": [1, 2]})
+    model = config.model
+    opt = config.model.opt
+    config2 = config.copy()
+    config3 = config2.copy()
+    # writes through nodes fetched before copy() stay in the original
+    model.lr = 5
+    opt.m = 0.5
+    config.layers.append(3)
+    assert config.model.lr == 5 and config.model.opt.m == 0.5
+    assert config_to_dict(config2) == {"model": {"lr": 1, "opt": {"m": 0.9}}, "layers": [1, 2]}
+    assert config_to_dict(config3) == config_to_dict(config2)
+    model.lr = 7
+    assert config.model.lr == 7 and config2.model.lr == 1
+    config3.model.opt.m = 0.1
+    assert config2.model.opt.m == 0.9 and config.model.opt.m == 0.5
+    assert config_usage_to_dict(config, "count")["model"]["lr"] > 0
+    print("copy on write ok")
+
+def test_generate_twice_memory():
+    # the second run reads the config index written by the first
+    from rena.experiment import generate_random_config_search, load_config_hashes
+    prefix = "memory://test_generate_twice"
+    generate_random_config_search("configs/std", "configs/std_search", prefix, 3)
+    generate_random_config_search("configs/std", "configs/std_search", prefix, 3)
+    assert len(load_config_hashes(prefix)) == 6
+    print("generate twice ok")
+
 import time
 
 def test_fn(config):